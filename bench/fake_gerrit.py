@@ -0,0 +1,188 @@
+#!/bin/env python
+
+import copy
+import json
+import logging
+import re
+import socket
+import threading
+import time
+
+import paramiko
+
+
+# Minimum delay before closing a channel: the exec request has to
+# be acked before the client sees the channel closing
+MIN_LATENCY = 0.005
+
+_CHANGE = re.compile(r'change:(\d+)')
+_CURRENT_PS = re.compile(r'--current-patch-set (\d+)')
+
+log = logging.getLogger(__name__)
+
+
+def load_fixture(path, comments=1):
+    '''
+    Load a query row (e.g. samples/pset.sample); the comment history
+    is replicated `comments` times to inflate the payload.
+    '''
+    with open(path) as f:
+        row = json.loads(f.read().strip().split('\n')[0])
+    history = row.get('comments', [])
+    if comments > 1 and history:
+        inflated = []
+        last = history[-1]['timestamp']
+        for i in range(comments):
+            shift = (last - history[0]['timestamp'] + 1) * (i - comments + 1)
+            for c in history:
+                c = dict(c)
+                c['timestamp'] += shift
+                inflated.append(c)
+        row['comments'] = inflated
+    return row
+
+
+class _Server(paramiko.ServerInterface):
+
+    def __init__(self, gerrit):
+        self.gerrit = gerrit
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        cmd = command.decode('utf-8')
+        threading.Thread(target=self.gerrit.handle, args=(channel, cmd), daemon=True).start()
+        return True
+
+
+class FakeGerrit(object):
+    '''
+    A local ssh server answering 'gerrit query' with the given
+    fixture (whatever the requested change is), accepting 'gerrit
+    review' and keeping 'gerrit stream-events' open.
+    '''
+
+    def __init__(self, fixture, host='127.0.0.1', port=0, latency=0.0):
+        self.fixture = fixture
+        self.latency = latency
+        self.host = host
+        self.commands = []
+        self.transports = 0
+
+        self._key = paramiko.RSAKey.generate(2048)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(64)
+        self.port = self._sock.getsockname()[1]
+        self._stop = threading.Event()
+
+        # the fixture is serialized once, with and without comments
+        full = copy.deepcopy(fixture)
+        light = copy.deepcopy(fixture)
+        light.pop('comments', None)
+        self._rows = {True: json.dumps(full, separators=(',', ':')),
+                      False: json.dumps(light, separators=(',', ':'))}
+        self._number = '"number":{}'.format(json.dumps(fixture['number']))
+
+    def start(self):
+        threading.Thread(target=self._accept, name='fake-gerrit', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._sock.close()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self._key)
+            transport.start_server(server=_Server(self))
+            self.transports += 1
+
+    def _query(self, cmd):
+        changes = _CHANGE.findall(cmd) or _CURRENT_PS.findall(cmd)
+        template = self._rows['--comments' in cmd]
+        out = []
+        for change in changes:
+            out.append(template.replace(self._number, '"number":{}'.format(int(change)), 1))
+        out.append(json.dumps({'type': 'stats', 'rowCount': len(changes),
+                               'runTimeMilliseconds': int(self.latency * 1000)}))
+        return '\n'.join(out) + '\n'
+
+    def handle(self, channel, cmd):
+        self.commands.append(cmd)
+        time.sleep(max(self.latency, MIN_LATENCY))
+        try:
+            if cmd.startswith('gerrit query'):
+                channel.sendall(self._query(cmd).encode('utf-8'))
+            elif cmd.startswith('gerrit stream-events'):
+                while not self._stop.is_set() and not channel.closed:
+                    time.sleep(0.5)
+            elif not cmd.startswith('gerrit review'):
+                channel.sendall_stderr(('fatal: unknown command %s\n' % cmd).encode('utf-8'))
+            channel.send_exit_status(0)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+
+class ReplayGerrit(FakeGerrit):
+    '''
+    A FakeGerrit answering each command as the real gerrit did when
+    it was recorded (see lib/recorder.py), taking as long (times
+    `scale`); when a command was recorded more than once, the answers
+    are given in turn. The commands never recorded, or whose output
+    was too long to be recorded, get the fixture.
+    '''
+
+    def __init__(self, records, fixture, host='127.0.0.1', port=0, scale=1.0):
+        super(ReplayGerrit, self).__init__(fixture, host, port)
+        self.scale = scale
+        self.missed = 0
+        self._answers = {}
+        self._next = {}
+        self._lock = threading.Lock()
+        for _, cmd, seconds, out, err in records:
+            self._answers.setdefault(cmd, []).append((seconds, out, err))
+
+    def handle(self, channel, cmd):
+        with self._lock:
+            answers = self._answers.get(cmd, None)
+            if answers is None:
+                self.missed += 1
+            else:
+                i = self._next.get(cmd, 0)
+                self._next[cmd] = i + 1
+                seconds, out, err = answers[i % len(answers)]
+        if answers is None:
+            return super(ReplayGerrit, self).handle(channel, cmd)
+
+        self.commands.append(cmd)
+        time.sleep(max(seconds * self.scale, MIN_LATENCY))
+        try:
+            if out is None and cmd.startswith('gerrit query'):
+                out = self._query(cmd)
+            if out:
+                channel.sendall(out.encode('utf-8'))
+            if err:
+                channel.sendall_stderr(err.encode('utf-8'))
+            channel.send_exit_status(0)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
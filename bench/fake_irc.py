@@ -0,0 +1,56 @@
+#!/bin/env python
+
+import time
+
+
+class FakeEvent(object):
+    '''
+    The subset of irc.client.Event used by the bot callbacks.
+    '''
+    __slots__ = ('type', 'source', 'target', 'arguments')
+
+    def __init__(self, type, source, target, arguments):
+        self.type = type
+        self.source = source
+        self.target = target
+        self.arguments = arguments
+
+
+def pubmsg(nick, chan, msg):
+    # '+': the nick is identified (identify-msg cap)
+    return FakeEvent('pubmsg', '{}!{}@bench'.format(nick, nick), chan, ['+' + msg])
+
+
+def privmsg(nick, bot_nick, msg):
+    return FakeEvent('privmsg', '{}!{}@bench'.format(nick, nick), bot_nick, ['+' + msg])
+
+
+class FakeConnection(object):
+    '''
+    Stand in for irc.client.ServerConnection: sent messages are
+    recorded (with the time they were sent) instead of reaching a
+    server.
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self.sent = []
+        self._clock = clock
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def privmsg(self, target, text):
+        self.sent.append((self._clock(), target, text))
+
+    def join(self, channel, key=''):
+        pass
+
+    def part(self, channels, message=''):
+        pass
+
+    def cap(self, subcommand, *args):
+        pass
+
+    def get_nickname(self):
+        return 'cephbot'
@@ -0,0 +1,65 @@
+#!/bin/env python
+
+import http.server
+import re
+import threading
+import time
+
+
+# Lines of the fake job logs, the failure is near the end
+LOG_LINES = 20000
+
+_RANGE = re.compile(r'bytes=-(\d+)')
+
+FAILED_LOG = ('\n'.join('2021-03-12 10:00:00 | ok: [undercloud] line {}'.format(i)
+                        for i in range(LOG_LINES)) +
+              '\n2021-03-12 10:00:01 | fatal: [undercloud]: FAILED! => {"msg": "boom"}'
+              '\n2021-03-12 10:00:02 | PLAY RECAP\n').encode('utf-8')
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server.logs
+        server.requests.append(self.path)
+        time.sleep(server.latency)
+        body = FAILED_LOG
+        m = _RANGE.match(self.headers.get('Range', ''))
+        if m and server.ranges:
+            body = body[-int(m.group(1)):]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeLogServer(object):
+    '''
+    A local http (keep-alive) server answering any path with a
+    failed job log. With ranges=False, the Range header is ignored
+    and the whole log is sent, as some log servers do.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, ranges=True, latency=0.0):
+        self.ranges = ranges
+        self.latency = latency
+        self.requests = []
+        self._httpd = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.logs = self
+        self.host, self.port = self._httpd.server_address[:2]
+        self.url = 'http://{}:{}'.format(self.host, self.port)
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, name='fake-logs', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,79 @@
+#!/bin/env python
+'''
+Check that !gerrit flaky counts its whole window whatever was asked
+before: a change only asked for flaky, and another one asked for its
+logs first (which load the last ci_history CI comments only), must
+get the same report.
+
+    ./bench/flaky_window.py --comments 20
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'bot'))
+
+from bench import fake_gerrit  # noqa E402
+from bench import fake_irc  # noqa E402
+from bench import run  # noqa E402
+
+
+# Seconds without new lines after which a reply is over
+QUIET = 0.5
+
+
+def _reply(b, c, cmd):
+    '''
+    Run the command and return all the lines of its reply.
+    '''
+    seen = len(c.sent)
+    run.run(b, c, [cmd], 1, 0)
+    last, count = time.monotonic(), len(c.sent)
+    while time.monotonic() - last < QUIET:
+        b.reactor.process_once(0.01)
+        if len(c.sent) != count:
+            last, count = time.monotonic(), len(c.sent)
+    return [text for _, _, text in c.sent[seen:]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--comments', type=int, default=20,
+                        help='how many times the fixture comment history is replicated')
+    parser.add_argument('--fixture', default=os.path.join(ROOT, 'samples', 'pset.sample'))
+    args = parser.parse_args()
+    args.cache_ttl = 300
+    args.workers = 2
+    args.flood_rate = 1000
+    args.flood_burst = 1000
+
+    with tempfile.TemporaryDirectory() as workdir:
+        gerrit = fake_gerrit.FakeGerrit(
+            fake_gerrit.load_fixture(args.fixture, args.comments)).start()
+        b = run.build_bot(args, workdir, gerrit, [run.BENCH_NICK], 4)
+        c = fake_irc.FakeConnection()
+        try:
+            # the fake gerrit answers the fixture for any change
+            alone = _reply(b, c, 'gerrit flaky 1001')
+            _reply(b, c, 'gerrit logs 1002')
+            after = [line.replace('1002', '1001') for line in _reply(b, c, 'gerrit flaky 1002')]
+        finally:
+            gerrit.stop()
+            b.workers.shutdown(wait=False)
+
+    print('flaky alone:\n  ' + '\n  '.join(alone))
+    print('flaky after logs:\n  ' + '\n  '.join(after))
+    if alone != after:
+        print('FAILED: the window asked after the logs is not fully counted')
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
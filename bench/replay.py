@@ -0,0 +1,164 @@
+#!/bin/env python
+'''
+Replay the traffic recorded by the bot (see the 'record' section of
+the irc config): the messages are injected into CephBot at their
+original pace (or --speed times faster) through a fake connection,
+and a fake gerrit answers each command as the real one did. The
+latency of the dispatch (running the callback) and of the reply
+(from the message to the first line sent) is reported per command.
+
+    ./bench/replay.py --speed 10 cephbot-traffic.log.gz
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'bot'))
+
+import config  # noqa E402
+import registry  # noqa E402
+from bench import fake_gerrit  # noqa E402
+from bench import fake_irc  # noqa E402
+from bench import run  # noqa E402
+from lib import recorder  # noqa E402
+
+
+def _key(b, w):
+    '''
+    The command (and subcommand) run by the tokens, None if it's not
+    a command the bot replies to.
+    '''
+    if not w:
+        return None
+    cmd, sub = b.registry.resolve(w)
+    if cmd is None:
+        return None
+    return cmd.name if sub is None else '{} {}'.format(cmd.name, sub.name)
+
+
+def _timed(b, dispatch):
+    '''
+    Measure how long the callbacks take, whatever thread runs them.
+    '''
+    orig = b._dispatch
+    lock = threading.Lock()
+
+    def _dispatch(w, nick, chan=None):
+        started = time.perf_counter()
+        try:
+            return orig(w, nick, chan)
+        finally:
+            key = _key(b, w) or '-'
+            with lock:
+                dispatch.setdefault(key, []).append(time.perf_counter() - started)
+    b._dispatch = _dispatch
+
+
+def replay(b, c, messages, speed):
+    '''
+    Inject the recorded messages, each one on its own channel (so the
+    reply can be told apart), and collect the reply latencies.
+    '''
+    schedule = [(t / speed, source, text) for t, etype, source, _, text in messages
+                if etype in ('pubmsg', 'privmsg')]
+    pending = {}
+    replies = {}
+    injected = 0
+    seen = 0
+    t0 = time.monotonic()
+    deadline = None
+    while schedule or pending:
+        now = time.monotonic()
+        while schedule and t0 + schedule[0][0] <= now:
+            _, source, text = schedule.pop(0)
+            chan = '#replay-{}'.format(injected)
+            injected += 1
+            # text starts with the identify-msg prefix
+            key = _key(b, registry.tokenize(text[1:]))
+            if key is not None:
+                pending[chan] = (key, time.monotonic())
+            b.on_pubmsg(c, fake_irc.FakeEvent('pubmsg', source, chan, [text]))
+
+        b.reactor.process_once(0.001)
+
+        for sent, target, _ in c.sent[seen:]:
+            if target in pending:
+                key, started = pending.pop(target)
+                replies.setdefault(key, []).append(sent - started)
+        seen = len(c.sent)
+
+        if not schedule:
+            deadline = deadline or time.monotonic() + run.REPLY_TIMEOUT
+            if time.monotonic() > deadline:
+                break
+    return replies, len(pending), time.monotonic() - t0
+
+
+def report(dispatch, replies, lost, elapsed, gerrit, b):
+    print('{:<24} {:>6} {:>13} {:>13} {:>9} {:>9} {:>9}'.format(
+        'command', 'n', 'dispatch p50', 'dispatch p95', 'reply p50', 'reply p95', 'reply p99'))
+    total = 0
+    for key in sorted(set(dispatch) | set(replies)):
+        d = dispatch.get(key, [])
+        r = replies.get(key, [])
+        total += len(r)
+        print('{:<24} {:>6} {:>10.1f} ms {:>10.1f} ms {:>6.1f} ms {:>6.1f} ms {:>6.1f} ms'.format(
+            key[:24], len(r),
+            run.percentile(d, 50) * 1000, run.percentile(d, 95) * 1000,
+            run.percentile(r, 50) * 1000, run.percentile(r, 95) * 1000,
+            run.percentile(r, 99) * 1000))
+    print('\n{} replies in {:.2f}s ({:.1f} cmd/s), {} lost'.format(
+        total, elapsed, total / elapsed if elapsed else 0, lost))
+    out = b.outbound.stats()
+    print('outbound: {} lines, max depth {}, avg wait {:.1f} ms, max wait {:.1f} ms'.format(
+        out['sent'], out['max_depth'], out['avg_wait'] * 1000, out['max_wait'] * 1000))
+    print('gerrit: {} commands replayed ({} not recorded) over {} ssh transport(s)'.format(
+        len(gerrit.commands), gerrit.missed, gerrit.transports))
+
+
+def main():
+    flood = config.irc.get('flood', {})
+    workers = config.irc.get('workers', {})
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help='the recorded traffic')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay N times faster than recorded')
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help='scale the recorded gerrit response times')
+    parser.add_argument('--fixture', default=os.path.join(ROOT, 'samples', 'pset.sample'),
+                        help='the answer to the gerrit queries not recorded')
+    parser.add_argument('--cache-ttl', type=int, default=0,
+                        help='change cache TTL (0: every command hits gerrit)')
+    parser.add_argument('--workers', type=int, default=workers.get('size', 4))
+    parser.add_argument('--max-pending', type=int, default=workers.get('max_pending', 16))
+    parser.add_argument('--flood-rate', type=float, default=flood.get('rate', 1.0))
+    parser.add_argument('--flood-burst', type=int, default=flood.get('burst', 5))
+    args = parser.parse_args()
+
+    messages, responses = recorder.load(args.log)
+    nicks = set(m[2].split('!')[0] for m in messages if m[2])
+
+    with tempfile.TemporaryDirectory() as workdir:
+        gerrit = fake_gerrit.ReplayGerrit(responses, fake_gerrit.load_fixture(args.fixture),
+                                          scale=args.latency_scale).start()
+        b = run.build_bot(args, workdir, gerrit, nicks, args.max_pending)
+        c = fake_irc.FakeConnection()
+        dispatch = {}
+        _timed(b, dispatch)
+        try:
+            replies, lost, elapsed = replay(b, c, messages, args.speed)
+            report(dispatch, replies, lost, elapsed, gerrit, b)
+        finally:
+            gerrit.stop()
+            b.workers.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    main()
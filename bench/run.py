@@ -0,0 +1,211 @@
+#!/bin/env python
+'''
+End to end benchmark of the bot: commands are injected into CephBot
+as PRIVMSG events of a fake connection, gerrit is replaced by a local
+ssh server answering with a fixture, and the time between the event
+and the first line of the reply is measured.
+
+    ./bench/run.py --count 100 --latency 0.05 --comments 20 \\
+        'gerrit status 778915' 'gerrit logs 778915' 'hello'
+
+With --logs, the job logs fetched by 'gerrit logs --triage' are
+served by a local http server, honoring the Range header or not:
+
+    ./bench/run.py --count 10 --logs full 'gerrit logs 778915 --triage'
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'bot'))
+
+import paramiko  # noqa E402
+
+import config  # noqa E402
+from bench import fake_gerrit  # noqa E402
+from bench import fake_irc  # noqa E402
+from bench import fake_logs  # noqa E402
+from lib import log_triage  # noqa E402
+
+
+BENCH_NICK = 'bench'
+
+# Give up on the replies not received after this amount of seconds
+REPLY_TIMEOUT = 120
+
+# Where the fixture jobs put their logs, served by the fake log server
+LOG_HOSTS = ['https://zuul.opendev.org', 'https://review.rdoproject.org']
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def _client_key(workdir):
+    path = os.path.join(workdir, 'bench_rsa')
+    paramiko.RSAKey.generate(2048).write_private_key_file(path)
+    return path
+
+
+def setup(args, workdir):
+    '''
+    Start the fake gerrit and build a CephBot pointing to it.
+    '''
+    gerrit = fake_gerrit.FakeGerrit(
+        fake_gerrit.load_fixture(args.fixture, args.comments),
+        latency=args.latency).start()
+    return gerrit, build_bot(args, workdir, gerrit, [BENCH_NICK],
+                             args.count * len(args.commands))
+
+
+def setup_logs(args):
+    '''
+    Start the fake log server (if asked to), and point the triage
+    of the fixture jobs to it.
+    '''
+    if not args.logs:
+        return None
+    logs = fake_logs.FakeLogServer(ranges=args.logs == 'range', latency=args.latency).start()
+    config.gerrit_config['triage'] = {'rewrite': dict((h, logs.url) for h in LOG_HOSTS)}
+    return logs
+
+
+def build_bot(args, workdir, gerrit, nicks, max_pending):
+    '''
+    Build a CephBot talking to the given fake gerrit, and accepting
+    the commands of the given nicks.
+    '''
+    config.gerrit_config.update({
+        'instance': gerrit.host,
+        'port': gerrit.port,
+        'user': {'name': BENCH_NICK, 'psw': 'None', 'key': _client_key(workdir)},
+        'cache': {'ttl': args.cache_ttl, 'revalidate': args.cache_ttl > 0},
+        'stream': {'enabled': False},
+    })
+    config.irc['allowed_nicks'] = list(nicks)
+    config.irc['command_nicks'] = {}
+    config.irc['flood'] = {'rate': args.flood_rate, 'burst': args.flood_burst, 'tick': 0.05}
+    config.irc['workers'] = {'size': args.workers,
+                             'max_pending': max_pending,
+                             'timeout': REPLY_TIMEOUT}
+    config.irc.pop('record', None)
+    config.irc.pop('reload', None)
+
+    # the bot reads the config when it's built
+    import bot
+    b = bot.CephBot('127.0.0.1', 'cephbot', '', [],
+                    os.path.join(workdir, 'bench.log'), [], 6667)
+    b.identify_msg_cap = True
+    return b
+
+
+def run(b, c, commands, count, rate):
+    '''
+    Inject count rounds of commands (a round every 1/rate seconds, all
+    at once if rate is 0) and collect the reply latencies.
+    '''
+    schedule = []
+    for i in range(count):
+        for cmd in commands:
+            schedule.append((i / rate if rate else 0.0, cmd))
+
+    pending = {}
+    results = dict((cmd, []) for cmd in commands)
+    injected = 0
+    seen = 0
+    t0 = time.monotonic()
+    deadline = None
+    while schedule or pending:
+        now = time.monotonic()
+        while schedule and t0 + schedule[0][0] <= now:
+            _, cmd = schedule.pop(0)
+            chan = '#bench-{}'.format(injected)
+            injected += 1
+            pending[chan] = (cmd, time.monotonic())
+            b.on_pubmsg(c, fake_irc.pubmsg(BENCH_NICK, chan, '!' + cmd))
+
+        b.reactor.process_once(0.001)
+
+        for sent, target, _ in c.sent[seen:]:
+            if target in pending:
+                cmd, started = pending.pop(target)
+                results[cmd].append(sent - started)
+        seen = len(c.sent)
+
+        if not schedule:
+            deadline = deadline or time.monotonic() + REPLY_TIMEOUT
+            if time.monotonic() > deadline:
+                break
+    elapsed = time.monotonic() - t0
+    return results, len(pending), elapsed
+
+
+def report(results, lost, elapsed, gerrit, logs=None):
+    print('{:<30} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'command', 'n', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'cmd/s'))
+    total = 0
+    for cmd, lat in results.items():
+        total += len(lat)
+        print('{:<30} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            cmd[:30], len(lat),
+            percentile(lat, 50) * 1000, percentile(lat, 95) * 1000,
+            percentile(lat, 99) * 1000, max(lat or [0]) * 1000,
+            len(lat) / elapsed if elapsed else 0))
+    print('\n{} replies in {:.2f}s ({:.1f} cmd/s), {} lost'.format(
+        total, elapsed, total / elapsed if elapsed else 0, lost))
+    print('gerrit: {} commands over {} ssh transport(s)'.format(
+        len(gerrit.commands), gerrit.transports))
+    if logs is not None:
+        t = log_triage.get_triage(config.gerrit_config).stats()
+        print('logs: {} requests ({}), {} fetched, {} bytes read, {} cached hits'.format(
+            len(logs.requests), 'range' if logs.ranges else 'no range',
+            t['fetched'], t['bytes'], t['hits']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('commands', nargs='*', default=['gerrit status 778915'])
+    parser.add_argument('--count', type=int, default=50,
+                        help='rounds of commands to inject')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='rounds per second (0: inject everything at once)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds gerrit waits before answering')
+    parser.add_argument('--comments', type=int, default=1,
+                        help='how many times the fixture comment history is replicated')
+    parser.add_argument('--fixture', default=os.path.join(ROOT, 'samples', 'pset.sample'))
+    parser.add_argument('--cache-ttl', type=int, default=0,
+                        help='change cache TTL (0: every command hits gerrit)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--flood-rate', type=float, default=1000)
+    parser.add_argument('--flood-burst', type=int, default=1000)
+    parser.add_argument('--logs', choices=['range', 'full'],
+                        help='serve the job logs, with Range support or always in full')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        logs = setup_logs(args)
+        gerrit, b = setup(args, workdir)
+        c = fake_irc.FakeConnection()
+        try:
+            results, lost, elapsed = run(b, c, args.commands, args.count, args.rate)
+            report(results, lost, elapsed, gerrit, logs)
+        finally:
+            gerrit.stop()
+            if logs is not None:
+                logs.stop()
+            b.workers.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,254 @@
 #!/bin/env python
 
-import irc.bot
-import daemon
-import sys
-import os
-import re
-import logging
-import callback
-import textwrap
 import time
+
+# taken before anything else is imported, to measure how long the
+# bot takes to be ready
+STARTED = time.perf_counter()
+
+import irc.bot  # noqa E402
+import irc.client  # noqa E402
+import daemon  # noqa E402
+import sys  # noqa E402
+import os  # noqa E402
+import logging  # noqa E402
+import callback  # noqa E402
+import config_reload  # noqa E402
+import outbound  # noqa E402
+import pager  # noqa E402
+import registry  # noqa E402
+from network import ReactorView, WakeableReactor, networks  # noqa E402
+import textwrap  # noqa E402
+import queue  # noqa E402
+from concurrent.futures import ThreadPoolExecutor  # noqa E402
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import config  # noqa E402
+from lib import change_cache  # noqa E402
+from lib import logs  # noqa E402
+from lib import metrics  # noqa E402
+from lib import recorder  # noqa E402
+from lib import single_flight  # noqa E402
+
+
+# Default worker pool settings (see the 'workers' section of config.irc)
+WORKERS = 4
+MAX_PENDING = 16
+COMMAND_TIMEOUT = 60
+
+# How often (in seconds) the metrics file is written, if configured
+METRICS_INTERVAL = 30
+
+# The modules holding process wide objects built from the gerrit
+# config (pools, caches, stores): the ones already imported are told
+# about a reloaded config, to rebuild or adjust them
+RECONFIGURED = ['lib.change_cache', 'lib.gerrit_ssh', 'lib.gerrit_rest', 'lib.log_triage',
+                'lib.job_history', 'lib.snapshot_store', 'lib.patch_set']
+
+
+class _Job(object):
+    '''
+    A command running on the worker pool: whoever comes first
+    between the result and the timeout replies.
+    '''
+    __slots__ = ('c', 'target', 'cmd', 'started', 'done')
+
+    def __init__(self, c, target, cmd, started):
+        self.c = c
+        self.target = target
+        self.cmd = cmd
+        self.started = started
+        self.done = False
+
+
+class BotHost(object):
+    '''
+    What the bots of all the networks served by the process share:
+    the reactor (a single loop for all the connections), the worker
+    pool, the command registry and the gerrit background tasks.
+    '''
+
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        # the reactor is not thread safe: other threads hand their
+        # calls over using call_in_reactor(), which wakes it up
+        self._calls = queue.Queue()
+        self.reactor = WakeableReactor(self._run_calls)
+        self.bots = []
+        self.ready = None
+        self.events = None
+        self.watcher = None
+
+        # slow callbacks run on a bounded worker pool, so the reactor
+        # keeps serving other commands (and answering PINGs)
+        workers = config.irc.get('workers', {})
+        self.max_pending = workers.get('max_pending', MAX_PENDING)
+        self.timeout = workers.get('timeout', COMMAND_TIMEOUT)
+        self.timeouts = workers.get('timeouts', {})
+        self.workers = ThreadPoolExecutor(max_workers=workers.get('size', WORKERS),
+                                          thread_name_prefix='cephbot-worker')
+        self.pending = 0
+
+        # command name -> handler and metadata, built once
+        self.registry = registry.build(callback, config.irc)
+
+        m = metrics.get_metrics()
+        m.add_collector(self._gauges)
+        textfile = config.irc.get('metrics', {}).get('textfile', None)
+        if textfile is not None:
+            self.reactor.scheduler.execute_every(
+                config.irc['metrics'].get('interval', METRICS_INTERVAL),
+                lambda: self._write_metrics(textfile))
+
+        # apply the changes of the config file as soon as it's saved
+        # (!reload does the same on demand)
+        opts = config.irc.get('reload', {})
+        if opts.get('watch', False):
+            watcher = config_reload.ConfigWatcher(config.__file__, self.reload)
+            self.reactor.scheduler.execute_every(
+                opts.get('interval', config_reload.INTERVAL), watcher.check)
+
+    def start(self):
+        for bot in self.bots:
+            bot._connect()
+        self.reactor.process_forever()
+
+    def on_ready(self, bot):
+        '''
+        Called by each bot once it has joined its channels.
+        '''
+        if self.ready is None:
+            self.ready = time.perf_counter() - STARTED
+            self.log.info("Bot ready (connected to %s and joined) in %.3fs",
+                          bot.server, self.ready)
+            # the gerrit dependencies are not loaded yet: import them in
+            # background rather than when the first command comes
+            if config.irc.get('warmup', True):
+                self.workers.submit(registry.warm_up)
+        self._gerrit_tasks()
+
+    def _gerrit_tasks(self):
+        '''
+        Start (or stop) the gerrit background tasks enabled (or
+        disabled) in the config.
+        '''
+        # follow the watched submissions using gerrit stream-events
+        enabled = config.gerrit_config.get('stream', {}).get('enabled', False)
+        if self.events is None and enabled:
+            from lib import gerrit_events
+            self.events = gerrit_events.EventStream(config.gerrit_config, self.announce)
+            self.events.start()
+        elif self.events is not None and not enabled:
+            self.events.stop()
+            self.events = None
+
+        # act (rebase/recheck) on the watched submissions failing CI
+        enabled = config.gerrit_config.get('watch', {}).get('enabled', False)
+        if self.watcher is None and enabled:
+            from lib import watcher
+            self.watcher = watcher.WatchScheduler(config.gerrit_config, self.announce)
+            self.watcher.start()
+        elif self.watcher is not None and not enabled:
+            self.watcher.stop()
+            self.watcher = None
+
+    def reload(self):
+        '''
+        Load the config file again and apply the differences, keeping
+        the connections: the gerrit pools, caches and stores follow
+        their new settings. A broken config is refused and the
+        current one is kept. To be run by the reactor; return a
+        message describing the outcome.
+        '''
+        try:
+            new = config_reload.load(config.__file__)
+            # the derived indexes are built before anything changes
+            reg = registry.build(callback, new.irc)
+            nets = networks(new.irc)
+        except Exception as e:
+            self.log.error("Not reloading the config: %s", e)
+            return "The new config is broken, keeping the current one: %s" % e
+
+        old = config.gerrit_config
+        config.gerrit_config, config.irc = new.gerrit_config, new.irc
+        self.registry = reg
+        workers = config.irc.get('workers', {})
+        self.max_pending = workers.get('max_pending', MAX_PENDING)
+        self.timeout = workers.get('timeout', COMMAND_TIMEOUT)
+        self.timeouts = workers.get('timeouts', {})
+        for bot in self.bots:
+            bot.reconfigure(nets.get(bot.network.get('name', 'default'), None))
+        for name in set(nets) - set(b.network.get('name', 'default') for b in self.bots):
+            self.log.warning("Network %s needs a restart to be joined", name)
+
+        for name in RECONFIGURED:
+            module = sys.modules.get(name, None)
+            if module is None:
+                continue
+            try:
+                module.reconfigure(old, config.gerrit_config)
+            except Exception as e:
+                self.log.warning("Unable to apply the new config to %s: %s", name, e)
+        if self.events is not None:
+            self.events.update(config.gerrit_config)
+        if self.watcher is not None:
+            self.watcher.update(config.gerrit_config)
+        if self.ready is not None:
+            self._gerrit_tasks()
+        self.log.info("Config reloaded")
+        return "Config reloaded!"
+
+    def call_in_reactor(self, fn, *args):
+        '''
+        Schedule fn(*args) to be run by the reactor thread.
+        '''
+        self._calls.put((fn, args))
+        self.reactor.wake()
+
+    def _run_calls(self):
+        while True:
+            try:
+                fn, args = self._calls.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fn(*args)
+            except Exception as e:
+                self.log.error("Scheduled call failed: %s", e)
+
+    def announce(self, msg):
+        '''
+        Post a gerrit event on every network; it's called by the
+        event stream (or watcher) thread.
+        '''
+        for bot in self.bots:
+            self.call_in_reactor(bot._announce, msg)
+
+    def _gauges(self):
+        g = {
+            'cephbot_startup_seconds': self.ready or 0,
+            'cephbot_pending_commands': self.pending,
+            'cephbot_outbound_queue_depth': sum(b.outbound.depth() for b in self.bots),
+            'cephbot_networks': len(self.bots),
+            'cephbot_paged_replies': sum(b.pager.stats()['replies'] for b in self.bots),
+            'cephbot_paged_bytes': sum(b.pager.stats()['bytes'] for b in self.bots),
+        }
+        for k, v in change_cache.get_cache(config.gerrit_config).stats().items():
+            g['cephbot_cache_%s' % k] = v
+        for k, v in single_flight.get_flight().stats().items():
+            g['cephbot_singleflight_%s' % k] = v
+        if self.watcher is not None:
+            for k, v in self.watcher.stats().items():
+                g['cephbot_watch_%s' % k] = v
+        return g
+
+    def _write_metrics(self, path):
+        try:
+            metrics.get_metrics().write_textfile(path)
+        except Exception as e:
+            self.log.error("Unable to write the metrics to %s: %s", path, e)
 
 
-# When a msg is split, we should sleep a specific amount of time before
-# sending the next part. Freenode allows an higher rate, but this sleep
-# time should be enough.
-MESSAGE_CONTINUATION_SLEEP = 0.5
-
-# Sleep time between sent messages
-ANTI_FLOOD_SLEEP = 2
-
 class CephBot(irc.bot.SingleServerIRCBot):
     def __init__(
             self,
@@ -31,7 +258,27 @@ class CephBot(irc.bot.SingleServerIRCBot):
             channel: list,
             log_path: str,
             interact_with: list,
-            port=6667):
+            port=6667,
+            host=None,
+            network=None):
+        '''
+        :param host is the BotHost shared with the bots of the other
+            networks (a new one is created if not provided)
+        :param network holds the settings of this network (flood,
+            announce), default: the irc config
+        '''
+
+        imported = time.perf_counter()
+        # records are written by a background thread, off the reactor
+        logs.setup(config.irc.get('logging', {}), log_path)
+        self.log = logging.getLogger(__name__)
+        # the traffic can be recorded, to be replayed by bench/replay.py
+        self.recorder = recorder.setup(config.irc.get('record', {}))
+
+        self.host = host if host is not None else BotHost()
+        # a view on the shared reactor, dispatching only the events
+        # of this connection to this bot
+        self.reactor_class = lambda: ReactorView(self.host.reactor)
 
         super(CephBot, self).__init__(
             server_list=[(server, int(port))],
@@ -45,9 +292,33 @@ class CephBot(irc.bot.SingleServerIRCBot):
         self.channel = channel
         self.server = server
         self.port = port
-
-        logging.basicConfig(filename=log_path, level=logging.DEBUG)
-        self.log = logging.getLogger(__name__)
+        self.network = network if network is not None else config.irc
+
+        # shared by all the networks
+        self.workers = self.host.workers
+        self.registry = self.host.registry
+        self.timeout = self.host.timeout
+        self.timeouts = self.host.timeouts
+
+        # replies are queued and sent by the reactor, according to the
+        # flood settings of the server
+        flood = self.network.get('flood', {})
+        self.outbound = outbound.OutboundQueue(flood.get('rate', outbound.RATE),
+                                               flood.get('burst', outbound.BURST))
+        self.reactor.scheduler.execute_every(flood.get('tick', outbound.TICK),
+                                             self.outbound.drain)
+
+        # long replies are sent a page at a time (see !more)
+        pages = self.network.get('pager', {})
+        self.pager = pager.ReplyStore(pages.get('lines', pager.PAGE_LINES),
+                                      pages.get('ttl', pager.TTL),
+                                      pages.get('max_bytes', pager.MAX_BYTES))
+        self.reactor.scheduler.execute_every(pager.EXPIRE_INTERVAL, self.pager.expire)
+        self.host.bots.append(self)
+
+        now = time.perf_counter()
+        self.log.info("Bot for %s initialized in %.3fs (imports: %.3fs, setup: %.3fs)",
+                      server, now - STARTED, imported - STARTED, now - imported)
 
     def on_welcome(self, c, e):
         '''
@@ -59,16 +330,72 @@ class CephBot(irc.bot.SingleServerIRCBot):
         c.cap('END')
 
         for ch in self.channel:
-            self.log.debug('Joining %s' % ch)
+            self.log.debug('Joining %s', ch)
             c.join(ch)
 
+        self.host.on_ready(self)
+
+    def call_in_reactor(self, fn, *args):
+        '''
+        Schedule fn(*args) to be run by the reactor thread.
+        '''
+        self.host.call_in_reactor(fn, *args)
+
+    def reconfigure(self, network):
+        '''
+        Apply the new settings of this network: the channels are
+        joined or parted, the flood and pager settings updated; the
+        server and the nick need a restart.
+        '''
+        self.registry = self.host.registry
+        self.timeout = self.host.timeout
+        self.timeouts = self.host.timeouts
+        if network is None:
+            self.log.warning("%s is not in the config anymore, it needs a restart to be dropped",
+                             self.server)
+            return
+        for key in ('server', 'port', 'nick'):
+            if network.get(key) != self.network.get(key):
+                self.log.warning("The %s of %s changed, it needs a restart", key, self.server)
+
+        channels = network.get('channels', [])
+        if self.connection.is_connected():
+            for ch in channels:
+                if ch not in self.channel:
+                    self.log.info("Joining %s", ch)
+                    self.connection.join(ch)
+            for ch in self.channel:
+                if ch not in channels:
+                    self.log.info("Leaving %s", ch)
+                    self.connection.part(ch)
+        self.channel = list(channels)
+
+        flood = network.get('flood', {})
+        self.outbound.bucket.rate = float(flood.get('rate', outbound.RATE))
+        self.outbound.bucket.burst = float(flood.get('burst', outbound.BURST))
+        pages = network.get('pager', {})
+        self.pager.page_lines = max(2, pages.get('lines', pager.PAGE_LINES))
+        self.pager.ttl = pages.get('ttl', pager.TTL)
+        self.pager.max_bytes = pages.get('max_bytes', pager.MAX_BYTES)
+        self.network = network
+
+    def _announce(self, msg):
+        '''
+        Post a gerrit event on the announce channels of this network
+        (default: the stream channels, or the joined ones).
+        '''
+        chans = self.network.get('announce', config.gerrit_config.get('stream', {}).get(
+            'channels', self.channel))
+        for ch in chans:
+            self.send_wrapped_msg(self.connection, ch, msg)
+
     def on_cap(self, c, e):
         '''
         The identify-msg capability causes the server to send an
         "identification" prefix in the message parameter of PRIVMSG
         and NOTICES commands.
         '''
-        self.log.debug("Received cap response %s" % repr(e.arguments))
+        self.log.debug("Received cap response %r", e.arguments)
         if e.arguments[0] == 'ACK' and 'identify-msg' in e.arguments[1]:
             self.log.debug("identify-msg cap acked")
             self.identify_msg_cap = True
@@ -78,6 +405,8 @@ class CephBot(irc.bot.SingleServerIRCBot):
         The prefix is a single character, + (ASCII plus) if the sender is
         "identified" according to services, - (ASCII minus) otherwise.
         '''
+        if self.recorder is not None:
+            self.recorder.irc(e)
         if not self.identify_msg_cap:
             self.log.debug("Ignoring msg from a not well identified user")
             return
@@ -86,9 +415,11 @@ class CephBot(irc.bot.SingleServerIRCBot):
         nick = e.source.split('!')[0]
         args = e.arguments[0][1:]  # removing the '+' at the beginning
 
-        self.send_wrapped_msg(c, nick, (self._handle_msg(args, nick)))
+        self._process(c, nick, args, nick)
 
     def on_pubmsg(self, c, e):
+        if self.recorder is not None:
+            self.recorder.irc(e)
         if not self.identify_msg_cap:
             self.log.debug("Ignoring msg from a not well identified user")
             return
@@ -97,8 +428,71 @@ class CephBot(irc.bot.SingleServerIRCBot):
         args = e.arguments[0][1:]  # removing the '+' at the beginning
         chan = e.target
 
-        self.log.debug("Replying on chan: %s" % chan)
-        self.send_wrapped_msg(c, chan, (self._handle_msg(args, nick)))
+        self.log.debug("Replying on chan: %s", chan)
+        self._process(c, chan, args, nick, chan)
+
+    def _process(self, c, target, msg, nick, chan=None):
+        '''
+        Run the command found in msg and reply to target: cheap
+        commands are run right away, the others on the worker pool.
+        '''
+        started = time.perf_counter()
+        w = self._tokenize(msg, nick)
+        if w is None:
+            return
+        if len(w) < 1 or self.registry.cost(w) == 'cheap':
+            self._reply(c, target, self._dispatch(w, nick, chan))
+            self._account(w[0] if w else None, started)
+            return
+
+        if self.host.pending >= self.host.max_pending:
+            self._reply(c, target, "I'm quite busy right now, please try again later!")
+            return
+
+        job = _Job(c, target, w[0], started)
+        self.host.pending += 1
+        future = self.workers.submit(self._dispatch, w, nick, chan)
+        future.add_done_callback(lambda f: self.call_in_reactor(self._complete, job, f))
+        self.reactor.scheduler.execute_after(self.timeouts.get(w[0], self.timeout),
+                                             lambda: self._expire(job))
+
+    def _complete(self, job, future):
+        self.host.pending -= 1
+        if job.done:
+            self.log.debug("Discarding the late result of %s", job.cmd)
+            return
+        job.done = True
+        try:
+            self._reply(job.c, job.target, future.result())
+            self._account(job.cmd, job.started)
+        except Exception as e:
+            self.log.error("Command %s failed: %s", job.cmd, e)
+            self._reply(job.c, job.target, "Sorry, something went wrong running '%s'" % job.cmd)
+            self._account(job.cmd, job.started, 'errors')
+
+    def _expire(self, job):
+        if job.done:
+            return
+        job.done = True
+        self.log.warning("Command %s timed out", job.cmd)
+        self._reply(job.c, job.target, "Sorry, '%s' is taking too long, giving up!" % job.cmd)
+        self._account(job.cmd, job.started, 'timeouts')
+
+    def _account(self, cmd, started, outcome=None):
+        '''
+        Update the per command counters and latency histogram (only
+        for the registered commands).
+        '''
+        if cmd is None or self.registry.lookup(cmd) is None:
+            return
+        metrics.inc('cephbot_commands_total', command=cmd)
+        if outcome is not None:
+            metrics.inc('cephbot_command_%s_total' % outcome, command=cmd)
+        metrics.observe('cephbot_command_seconds', time.perf_counter() - started, command=cmd)
+
+    def _reply(self, c, target, msg):
+        if msg:
+            self.send_wrapped_msg(c, target, msg)
 
     def _handle_msg(self,
             msg: str,
@@ -107,57 +501,59 @@ class CephBot(irc.bot.SingleServerIRCBot):
         '''
         Process a generic message, sent on a pub channel or as privmsg.
         '''
-        if len(msg.split()) < 1:
-            self.log.debug("Ignoring msg from %s because no content is provided" % nick)
-        wds = msg.lower()
-        if wds.startswith('#') or wds.startswith('+') or wds.startswith('!'):
-            wds = msg.lower()[1:]
-
-            # if it's a pubmsg, make sure it can be processes only if the nick
-            # is +v and +o
-
-            #if chan is not None and self._is_voiced(nick, chan)):
-            #    print("Processing and executing %s" % w)
-
-            # normalize words, removing all that fun human symbols
-            wds = re.sub(r'[?|$|.|!|,|>|<|\]|\[|\{|\}|\/|\\|]', r'', wds).strip()
-
-            w = wds.split()
+        w = self._tokenize(msg, nick)
+        if w is None:
+            return
+        return self._dispatch(w, nick, chan)
 
-            self.log.debug("(Normalized) tokens: %s" % w)
+    def _tokenize(self, msg, nick):
+        '''
+        Return the normalized tokens of a command, None if the
+        message is not addressed to the bot.
+        '''
+        if len(msg.split()) < 1:
+            self.log.debug("Ignoring msg from %s because no content is provided", nick)
 
-            if len(w) < 1:
-                return self._usage()
+        # if it's a pubmsg, make sure it can be processes only if the nick
+        # is +v and +o
 
-            self.log.debug("Processing and executing %s" % w[0])
+        #if chan is not None and self._is_voiced(nick, chan)):
+        #    print("Processing and executing %s" % w)
 
-            kw = {
-                'callback': callback,
-                'nick': self.nick,
-                'chan': chan,
-                'args': w[1:]
-            }
+        w = registry.tokenize(msg)
+        if w is not None:
+            self.log.debug("(Normalized) tokens: %s", w)
+        return w
 
-            '''
-            Check if it's a valid command and is allowed, then
-            call the proper registered callback (using the on_
-            prefix).
-            '''
-            if(hasattr(callback, 'on_{}'.format(w[0])) and \
-                    self._is_allowed(w[0], 'callback') and \
-                    self._is_allowed(nick, 'allowed_nicks')):
-                cb = getattr(callback, 'on_{}'.format(w[0]))
-                return cb(**kw)
-        return
+    def _dispatch(self, w, nick, chan=None):
+        '''
+        Call the callback matching the (normalized) tokens.
+        '''
+        if len(w) < 1:
+            return self._usage()
 
-    def _is_allowed(self, elem, key):
         '''
-        Only process commands explicitly allowed in the config
-        area, if the nick is allowed to do that!
-        :param elem is the item that can be or cannot be found in the list
-        :param key is the key of the dict returning the list where the item can be found
+        Only the commands registered at startup (the ones enabled in
+        the config) can be run, if the nick is allowed to do that!
         '''
-        return True if elem in config.irc.get(key, []) else False
+        cmd = self.registry.lookup(w[0])
+        if cmd is None or not cmd.allowed(nick):
+            return
+
+        self.log.debug("Processing and executing %s", w[0])
+
+        kw = {
+            'callback': callback,
+            'registry': self.registry,
+            'nick': self.nick,
+            'chan': chan,
+            'target': chan or nick,
+            'pager': self.pager,
+            'host': self.host,
+            'args': w[1:]
+        }
+        with metrics.span('handle_msg', command=cmd.name):
+            return cmd.handler(**kw)
 
     def _usage(self):
         return ("Sorry, I'm not able to understand that command or you're "
@@ -173,24 +569,33 @@ class CephBot(irc.bot.SingleServerIRCBot):
                     self.channels[chan].is_oper(nick))
 
     def send_wrapped_msg(self, c, chan, msg):
-        for chunks in msg.split('\n'):
-            # 400 chars should be safe
-            chunks = textwrap.wrap(chunks, 400)
-            if len(chunks) > 10:
-                raise Exception("Unusually large message: %s" % (msg,))
-            for _, chunk in enumerate(chunks):
-                c.privmsg(chan, chunk)
-                time.sleep(MESSAGE_CONTINUATION_SLEEP)
-        time.sleep(ANTI_FLOOD_SLEEP)
+        '''
+        Queue the (wrapped) message: it's sent by the reactor as the
+        flood control allows. Only the first page of a long message
+        is sent, the rest is kept for !more.
+        '''
+        with metrics.span('send_wrapped_msg'):
+            lines = []
+            for chunks in msg.split('\n'):
+                # 400 chars should be safe
+                lines.extend(textwrap.wrap(chunks, 400))
+            lines = self.pager.paginate(chan, lines)
+        self.outbound.put(c, chan, lines)
+        self.outbound.drain()
 
 
 if __name__ == '__main__':
 
-    bot = CephBot(config.irc.get('server', ''),
-            config.irc.get('nick', '_cephbot'),
-            config.irc.get('psw', ''),
-            config.irc.get('channels', []),
-            config.irc.get('log', 'cephbot.log'),
-            config.irc.get('allowed_nicks', ''),
-            config.irc.get('port', 0))
-    bot.start()
+    # a bot per network, all served by the same loop
+    host = BotHost()
+    for name, net in networks(config.irc).items():
+        CephBot(net.get('server', ''),
+                net.get('nick', '_cephbot'),
+                net.get('psw', ''),
+                net.get('channels', []),
+                net.get('log', 'cephbot.log'),
+                net.get('allowed_nicks', ''),
+                net.get('port', 0),
+                host=host,
+                network=net)
+    host.start()
@@ -8,23 +8,76 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import config  # noqa E402
-from lib import patch_set as ps  # noqa E402
+from lib import metrics  # noqa E402
+from registry import command, lazy  # noqa E402
+
+# gerrit (paramiko and friends) is loaded the first time it's needed
+ps = lazy('lib.patch_set')
 
 def on_hello(**kwargs) -> str:
     nick = kwargs.get('nick', 'cephbot')
     return 'Hello, I\'m %s\'s bot, how can I help you' % (nick)
 
 def on_help(**kwargs) -> str:
-    available_functions = []
-    c = kwargs.get('callback', None)
-    if c is not None:
-        for f in dir(c):
-            if (f.startswith('on_') and \
-                    f.split('on_')[1] in config.irc.get('callback', [])):
-                available_functions.append('{}'.format(f[3:]))
-        return ('Available functions are: %s' % (', '.join(available_functions)))
+    # the list is built once, when the commands are registered
+    r = kwargs.get('registry', None)
+    if r is not None:
+        return r.help
     return ''
 
+def on_more(**kwargs) -> str:
+    '''
+    Show the next page of the last long reply.
+    '''
+    pages = kwargs.get('pager', None)
+    page = pages.more(kwargs.get('target')) if pages is not None else None
+    if page is None:
+        return "There's nothing more to show!"
+    return '\n'.join(page)
+
+def on_reload(**kwargs) -> str:
+    '''
+    Reload the config, keeping the connections and the caches.
+    '''
+    host = kwargs.get('host', None)
+    if host is None:
+        return "I can't reload the config from here!"
+    return host.reload()
+
+def on_stats(**kwargs) -> str:
+    '''
+    Show where the time goes: latency of each command and of
+    each stage of the hot path, plus a few gauges.
+    '''
+    m = metrics.get_metrics()
+
+    def _fmt(h):
+        return 'p50 {}s p95 {}s'.format(h.quantile(0.5), h.quantile(0.95))
+
+    cmds = ['{}: {} ({})'.format(labels['command'], h.count, _fmt(h))
+            for labels, h in sorted(m.histograms('cephbot_command_seconds'),
+                                    key=lambda x: x[0]['command'])]
+    stages = {}
+    for labels, h in m.histograms(metrics.SPAN):
+        # merge the per command (or mode) spans of a stage
+        stages.setdefault(labels['stage'], []).append(h)
+    spans = []
+    for stage, hs in sorted(stages.items()):
+        h = metrics.Histogram.merge(hs)
+        spans.append('{}: {} ({})'.format(stage, h.count, _fmt(h)))
+    gauges = ['{}: {}'.format(k.replace('cephbot_', ''), v) for k, v in sorted(m.gauges().items())]
+
+    return ('Commands: %s\nStages: %s\nGauges: %s' % (
+        ', '.join(cmds) or '-', ', '.join(spans) or '-', ', '.join(gauges) or '-'))
+
+@command(cost='slow', subcommands={
+    'status': {'help': 'last CI votes of a submission', 'cost': 'slow'},
+    'summary': {'help': 'current patchset of a submission', 'cost': 'slow'},
+    'logs': {'help': 'last CI jobs and logs of a submission', 'cost': 'slow'},
+    'diff': {'help': 'new votes and job results since the previous snapshot', 'cost': 'slow'},
+    'flaky': {'help': 'jobs failing most often in the CI history', 'cost': 'slow'},
+    'recheck': {'help': 'recheck a submission', 'kind': 'write', 'cost': 'slow'},
+    'rebase': {'help': 'rebase a submission', 'kind': 'write', 'cost': 'slow'}})
 def on_gerrit(**kwargs) -> str:
     '''
     This command can be processed if provided with the following
@@ -36,11 +89,14 @@ def on_gerrit(**kwargs) -> str:
 
     * summary
     * status
+    * logs (with --triage, the first error line of each failed job)
+    * diff
+    * flaky (the jobs failing most often, also for a group)
     * recheck
     * rebase
     '''
 
-    c_read = ['status', 'summary', 'logs']
+    c_read = ['status', 'summary', 'logs', 'diff', 'flaky']
     c_write = ['recheck', 'rebase']
     # process arguments
     args = kwargs.get('args', [])
@@ -49,9 +105,22 @@ def on_gerrit(**kwargs) -> str:
                "!gerrit <command> <submission_id> \n"
                "or ....\n"
                "just run '!gerrit status pending_ceph' to see the last CI execution status \n"
+               "or '!gerrit status all' (or a group name) to check many submissions at once \n"
                "Available gerrit functions are: %s" % (', '.join(list(itertools.chain(c_read, c_write)))))
 
     if args[0] in c_read:
+        # a group of changes (e.g. 'all' the watched ones) is
+        # loaded in parallel and shown in a single reply
+        group = ps.resolve_group(config.gerrit_config, args[1])
+        if group is not None:
+            if not group:
+                return "There are no submissions in %s!" % args[1]
+            if args[0] == 'flaky':
+                records = ps.load_history(config.gerrit_config, group)
+                return ps._show_flaky(config.gerrit_config, records) or \
+                    "No failing jobs in the CI history of %s!" % args[1]
+            records, timedout = ps.load_many(config.gerrit_config, group)
+            return ps._show_group(config.gerrit_config, args[0], records, timedout)
         try:
             if 'pending_ceph' in args[1]:
                 review = int(config.gerrit_config['pending_ceph'])
@@ -59,7 +128,25 @@ def on_gerrit(**kwargs) -> str:
                 review = int(args[1])
         except ValueError:
             return "The submission_id is wrong, it's not an int!"
+        if args[0] == "flaky":
+            # the whole flaky window, not the cached CI history
+            d = ps.load_history(config.gerrit_config, [review])[str(review)]
+            if d is None:
+                return ("I can't find review %d!" % review)
+            flaky = ps._show_flaky(config.gerrit_config, {str(review): d})
+            if len(flaky) == 0:
+                return ("No failing jobs in the CI history of review %d!" % review)
+            return flaky
+        if args[0] == "diff":
+            # the store already knows the review: no need to load
+            # its comments unless it changed
+            diff = ps._show_diff(config.gerrit_config, review, refresh=True)
+            if diff is None:
+                return ("I can't find review %d!" % review)
+            return "Review %d %s" % (review, diff)
         d = ps.load_latest_available_data(config.gerrit_config, review)
+        if d is None:
+            return ("I can't find review %d!" % review)
 
     # a switch - case statement looking for the proper ps function
     if args[0] == "status":
@@ -74,6 +161,11 @@ def on_gerrit(**kwargs) -> str:
         return (str(summary))
     elif args[0] == "logs":
         psnum, comments = ps.process_data(config.gerrit_config, d)
+        if '--triage' in args[2:]:
+            logs = ps._show_triage(config.gerrit_config, comments)
+            if len(logs) == 0:
+                return ("There are no failed jobs in the last CI runs of review %d!" % review)
+            return logs
         logs = ps._show_ci_logs(comments)
         if len(logs) == 0:
             return ("I'm not able to find any relevant log atm!")
@@ -82,6 +174,8 @@ def on_gerrit(**kwargs) -> str:
         return ("I barely understand what gerrit is, I don't remember a command like the "
                "one you run! (rebase and recheck are not yet available)")
 
+@command(subcommands={
+    'status': {'help': 'where the Ceph Squad status is tracked'}})
 def on_squad(**kwargs) -> str:
     '''
     This command can be processed if provided with the following
@@ -94,7 +188,8 @@ def on_squad(**kwargs) -> str:
     * status
     '''
     squad_etherpad = 'https://etherpad.openstack.org/p/tripleo-integration-squad-status'
-    subcmds = ['status']
+    # the subcommands registered with @command
+    subcmds = list(on_squad.command['subcommands'])
     # process arguments
     args = kwargs.get('args', [])
     if not args or len(args) < 1:
@@ -0,0 +1,87 @@
+#!/bin/env python
+
+import importlib.util
+import logging
+import os
+
+from network import networks
+
+
+# How often (in seconds) the config file is checked for changes, if
+# irc['reload']['watch'] is set
+INTERVAL = 5
+
+log = logging.getLogger(__name__)
+
+
+def load(path):
+    '''
+    Load the config file as a new module, without touching the one
+    in use: the old config is kept if the new one is broken.
+    '''
+    spec = importlib.util.spec_from_file_location('config', path)
+    conf = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(conf)
+    validate(conf)
+    return conf
+
+
+def validate(conf):
+    '''
+    Raise an Exception describing the first problem found.
+    '''
+    gerrit = getattr(conf, 'gerrit_config', None)
+    irc = getattr(conf, 'irc', None)
+    if not isinstance(gerrit, dict) or not isinstance(irc, dict):
+        raise Exception("gerrit_config and irc must be dictionaries")
+
+    for key in ('instance', 'port'):
+        if key not in gerrit:
+            raise Exception("gerrit_config: missing '%s'" % key)
+    if not isinstance(gerrit.get('allowed_ci', []), list):
+        raise Exception("gerrit_config: allowed_ci must be a list")
+    for r, opts in gerrit.get('submissions', {}).items():
+        try:
+            int(r)
+        except ValueError:
+            raise Exception("gerrit_config: submission %s is not a change number" % r)
+        if not isinstance(opts.get('actions', []), list):
+            raise Exception("gerrit_config: the actions of %s must be a list" % r)
+    for name, group in gerrit.get('groups', {}).items():
+        if not isinstance(group, list):
+            raise Exception("gerrit_config: group %s must be a list" % name)
+
+    for key in ('callback', 'allowed_nicks'):
+        if not isinstance(irc.get(key, []), list):
+            raise Exception("irc: %s must be a list" % key)
+    if not isinstance(irc.get('command_nicks', {}), dict):
+        raise Exception("irc: command_nicks must be a dictionary")
+    for name, net in networks(irc).items():
+        if not isinstance(net.get('channels', []), list):
+            raise Exception("irc: the channels of %s must be a list" % name)
+
+
+class ConfigWatcher(object):
+    '''
+    Tell when the config file changes, by looking at its mtime: it's
+    cheap enough to be checked by the reactor.
+    '''
+
+    def __init__(self, path, on_change):
+        self.path = path
+        self.on_change = on_change
+        self._mtime = self._stat()
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self):
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return
+        self._mtime = mtime
+        log.info("%s changed, reloading it", self.path)
+        self.on_change()
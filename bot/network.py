@@ -0,0 +1,92 @@
+#!/bin/env python
+
+import socket
+
+import irc.client
+
+
+def networks(irc_conf):
+    '''
+    Return the {name: settings} of the networks to connect to:
+    each entry of irc['networks'] overrides the top level settings
+    (server, port, nick, channels, flood, ...); without networks
+    the top level settings describe the only one. The settings
+    carry the name of their network.
+    '''
+    base = dict((k, v) for k, v in irc_conf.items() if k != 'networks')
+    nets = irc_conf.get('networks', None)
+    if not nets:
+        return {'default': dict(base, name='default')}
+    return dict((name, dict(base, name=name, **opts)) for name, opts in nets.items())
+
+
+class ReactorView(irc.client.Reactor):
+    '''
+    The reactor seen by the bot of a single network: connections,
+    scheduler and lock belong to the shared reactor (so a single
+    loop serves all the networks), but the handlers are its own,
+    so each bot only gets the events of its own connection.
+    '''
+
+    def __init__(self, shared):
+        super(ReactorView, self).__init__()
+        self.shared = shared
+        self.scheduler = shared.scheduler
+        self.mutex = shared.mutex
+
+    def server(self):
+        conn = self.connection_class(self)
+        with self.mutex:
+            self.connections.append(conn)
+            self.shared.connections.append(conn)
+        return conn
+
+    def _remove_connection(self, connection):
+        with self.mutex:
+            self.connections.remove(connection)
+            self.shared.connections.remove(connection)
+
+    def process_once(self, timeout=0):
+        self.shared.process_once(timeout)
+
+    def process_forever(self, timeout=0.2):
+        self.shared.process_forever(timeout)
+
+
+class WakeableReactor(irc.client.Reactor):
+    '''
+    A reactor other threads can wake up: wake() writes a byte on a
+    socketpair the select() waits on too, and on_wake is run as soon
+    as the loop notices, instead of at the next select timeout.
+    '''
+
+    def __init__(self, on_wake=None):
+        super(WakeableReactor, self).__init__()
+        self.on_wake = on_wake
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    @property
+    def sockets(self):
+        return super(WakeableReactor, self).sockets + [self._wake_r]
+
+    def wake(self):
+        try:
+            self._wake_w.send(b'x')
+        except BlockingIOError:
+            # the buffer is full: a wake up is already pending
+            pass
+
+    def process_data(self, sockets):
+        woken = self._wake_r in sockets
+        if woken:
+            try:
+                while self._wake_r.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+            sockets = [s for s in sockets if s is not self._wake_r]
+        super(WakeableReactor, self).process_data(sockets)
+        if woken and self.on_wake is not None:
+            self.on_wake()
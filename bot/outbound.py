@@ -0,0 +1,112 @@
+#!/bin/env python
+
+from collections import OrderedDict, deque
+import logging
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import metrics  # noqa E402
+
+
+# Default flood control: up to BURST lines sent back to back, then
+# RATE lines per second
+RATE = 1.0
+BURST = 5
+
+# How often (in seconds) the reactor drains the queue
+TICK = 0.2
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    '''
+    Classic token bucket: tokens are refilled at a fixed rate up to
+    the burst size, and sending a line costs a token.
+    '''
+
+    def __init__(self, rate=RATE, burst=BURST, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self._clock = clock
+        self._last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def consume(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class OutboundQueue(object):
+    '''
+    The lines the bot wants to send, queued per target and drained
+    round robin, so a long reply on a channel can't starve the
+    others. It's meant to be used by the reactor thread only.
+    '''
+
+    def __init__(self, rate=RATE, burst=BURST, clock=time.monotonic):
+        self.bucket = TokenBucket(rate, burst, clock)
+        self._clock = clock
+        self._targets = OrderedDict()
+        self._depth = 0
+        self._sent = 0
+        self._max_depth = 0
+        self._wait = 0.0
+        self._max_wait = 0.0
+
+    def put(self, c, target, lines):
+        q = self._targets.setdefault(target, deque())
+        now = self._clock()
+        for line in lines:
+            q.append((now, c, line))
+        self._depth += len(lines)
+        self._max_depth = max(self._max_depth, self._depth)
+
+    def drain(self):
+        '''
+        Send as many lines as the token bucket allows, one line per
+        target at a time.
+        '''
+        while self._targets and self.bucket.consume():
+            target, q = next(iter(self._targets.items()))
+            queued, c, line = q.popleft()
+            self._depth -= 1
+            if q:
+                self._targets.move_to_end(target)
+            else:
+                del self._targets[target]
+
+            wait = self._clock() - queued
+            self._wait += wait
+            self._max_wait = max(self._max_wait, wait)
+            metrics.observe(metrics.SPAN, wait, stage='outbound_wait')
+            try:
+                c.privmsg(target, line)
+                self._sent += 1
+            except Exception as e:
+                log.error("Unable to send a message to %s: %s", target, e)
+
+    def depth(self, target=None):
+        if target is None:
+            return self._depth
+        return len(self._targets.get(target, ()))
+
+    def stats(self):
+        return {
+            'depth': self._depth,
+            'max_depth': self._max_depth,
+            'targets': dict((t, len(q)) for t, q in self._targets.items()),
+            'sent': self._sent,
+            'avg_wait': self._wait / self._sent if self._sent else 0.0,
+            'max_wait': self._max_wait,
+        }
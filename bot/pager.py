@@ -0,0 +1,95 @@
+#!/bin/env python
+
+from collections import OrderedDict
+import time
+
+
+# Max lines sent at once: longer replies are paginated, the rest is
+# served by !more
+PAGE_LINES = 8
+
+# Seconds an untouched reply is kept
+TTL = 300
+
+# Max (total) size in bytes of the kept replies
+MAX_BYTES = 256 * 1024
+
+# How often (in seconds) the expired replies are dropped
+EXPIRE_INTERVAL = 60
+
+
+class ReplyStore(object):
+    '''
+    The pages of the long replies not sent yet, one reply per
+    target (nick or channel): a new long reply replaces the old
+    one, idle ones expire and the least recently used ones are
+    dropped when the store is full. It's meant to be used by the
+    reactor thread only.
+    '''
+
+    def __init__(self, page_lines=PAGE_LINES, ttl=TTL, max_bytes=MAX_BYTES, clock=time.monotonic):
+        self.page_lines = max(2, page_lines)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._clock = clock
+        # target -> (last used, remaining lines, size)
+        self._replies = OrderedDict()
+        self._size = 0
+
+    def paginate(self, target, lines):
+        '''
+        Return the first page of the reply, keeping the rest for
+        more(); a short reply doesn't affect what's kept.
+        '''
+        if len(lines) <= self.page_lines:
+            return lines
+        self._drop(target)
+        return self._page(target, lines)
+
+    def more(self, target):
+        '''
+        Return the next page of the reply kept for target, None if
+        there's nothing left.
+        '''
+        self.expire()
+        entry = self._drop(target)
+        if entry is None:
+            return None
+        return self._page(target, entry[1])
+
+    def _page(self, target, lines):
+        # the footer takes the place of the last line
+        if len(lines) <= self.page_lines:
+            return lines
+        n = self.page_lines - 1
+        page, rest = lines[:n], lines[n:]
+        self._keep(target, rest)
+        return page + ['({} more lines, type !more to see them)'.format(len(rest))]
+
+    def _keep(self, target, lines):
+        size = sum(len(x) for x in lines)
+        self._replies[target] = (self._clock(), lines, size)
+        self._size += size
+        while self._size > self.max_bytes and self._replies:
+            _, (_, _, dropped) = self._replies.popitem(last=False)
+            self._size -= dropped
+
+    def _drop(self, target):
+        entry = self._replies.pop(target, None)
+        if entry is not None:
+            self._size -= entry[2]
+        return entry
+
+    def expire(self):
+        now = self._clock()
+        while self._replies:
+            target, (used, _, _) = next(iter(self._replies.items()))
+            if now - used <= self.ttl:
+                break
+            self._drop(target)
+
+    def stats(self):
+        return {
+            'replies': len(self._replies),
+            'bytes': self._size,
+        }
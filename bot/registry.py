@@ -0,0 +1,208 @@
+#!/bin/env python
+
+import importlib
+import logging
+import re
+import threading
+import time
+
+
+# The prefix of the callback functions in the callback module
+CALLBACK_PREFIX = 'on_'
+
+# normalize words, removing all that fun human symbols
+_SYMBOLS = re.compile(r'[?|$|.|!|,|>|<|\]|\[|\{|\}|\/|\\|]')
+
+_COMMAND_PREFIXES = ('#', '+', '!')
+
+log = logging.getLogger(__name__)
+
+# the modules returned by lazy(), loaded by warm_up()
+_lazy = []
+
+
+def tokenize(msg):
+    '''
+    Return the normalized tokens of a command, None if the
+    message is not addressed to the bot.
+    '''
+    if not msg.startswith(_COMMAND_PREFIXES):
+        return None
+    return _SYMBOLS.sub('', msg[1:].lower()).split()
+
+
+def command(kind='read', cost='cheap', subcommands=None):
+    '''
+    Attach the dispatch metadata to a callback:
+
+    :param kind is either 'read' or 'write'
+    :param cost is 'cheap' (run by the reactor) or 'slow' (run on
+        the worker pool)
+    :param subcommands maps each subcommand to its own metadata
+        (help, kind and cost)
+    '''
+    def wrap(fn):
+        fn.command = {
+            'kind': kind,
+            'cost': cost,
+            'subcommands': subcommands or {},
+        }
+        return fn
+    return wrap
+
+
+class LazyModule(object):
+    '''
+    Stand in for a module that is actually imported the first time
+    one of its attributes is used: plugins use it for their heavy
+    dependencies, so they don't slow down the bot startup.
+    '''
+    __slots__ = ('_name', '_module', '_lock')
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    log.info("Loaded %s in %.3fs", self._name, time.perf_counter() - start)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+def lazy(name):
+    '''
+    Return a LazyModule for the given (dotted) module name.
+    '''
+    m = LazyModule(name)
+    _lazy.append(m)
+    return m
+
+
+def warm_up():
+    '''
+    Import all the lazy modules (e.g. in background, once the bot
+    is connected), so the first command doesn't pay for it.
+    '''
+    for m in _lazy:
+        try:
+            m.load()
+        except Exception as e:
+            log.error("Unable to load %s: %s", m._name, e)
+
+
+class Subcommand(object):
+    __slots__ = ('name', 'help', 'kind', 'cost')
+
+    def __init__(self, name, help='', kind='read', cost='cheap'):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.cost = cost
+
+
+class Command(object):
+    __slots__ = ('name', 'handler', 'allowed_nicks', 'help', 'kind', 'cost', 'subcommands')
+
+    def __init__(self, name, handler, allowed_nicks, help='', kind='read', cost='cheap'):
+        self.name = name
+        self.handler = handler
+        self.allowed_nicks = frozenset(allowed_nicks)
+        self.help = help
+        self.kind = kind
+        self.cost = cost
+        self.subcommands = {}
+
+    def allowed(self, nick):
+        return nick in self.allowed_nicks
+
+
+class CommandRegistry(object):
+    '''
+    Map each enabled command to its handler and metadata, so
+    dispatching a message costs a dict lookup.
+    '''
+
+    def __init__(self):
+        self._commands = {}
+        self.help = ''
+
+    def register(self, name, handler, allowed_nicks, help='', kind='read', cost='cheap'):
+        self._commands[name] = Command(name, handler, allowed_nicks, help, kind, cost)
+        self._build_help()
+        return self._commands[name]
+
+    def register_sub(self, name, sub, help='', kind='read', cost='cheap'):
+        self._commands[name].subcommands[sub] = Subcommand(sub, help, kind, cost)
+        self._build_help()
+
+    def lookup(self, name):
+        return self._commands.get(name, None)
+
+    def resolve(self, tokens):
+        '''
+        Return the (command, subcommand) matching the tokens; both
+        can be None.
+        '''
+        cmd = self._commands.get(tokens[0], None) if tokens else None
+        if cmd is None:
+            return None, None
+        sub = cmd.subcommands.get(tokens[1], None) if len(tokens) > 1 else None
+        return cmd, sub
+
+    def cost(self, tokens):
+        cmd, sub = self.resolve(tokens)
+        if cmd is None:
+            return 'cheap'
+        return sub.cost if sub is not None else cmd.cost
+
+    def names(self):
+        return sorted(self._commands.keys())
+
+    def _build_help(self):
+        available = []
+        for name in self.names():
+            subs = self._commands[name].subcommands
+            if subs:
+                available.append('{} ({})'.format(name, ', '.join(subs.keys())))
+            else:
+                available.append(name)
+        self.help = 'Available functions are: %s' % (', '.join(available))
+
+
+def build(module, irc_conf):
+    '''
+    Build the registry out of the on_<name> functions enabled in
+    the 'callback' list of the irc config: <name> is looked up in
+    the callback module, <plugin>:<name> in the given plugin module.
+    '''
+    reg = CommandRegistry()
+    nicks = irc_conf.get('allowed_nicks', [])
+    command_nicks = irc_conf.get('command_nicks', {})
+    for name in irc_conf.get('callback', []):
+        plugin = module
+        if ':' in name:
+            path, name = name.split(':', 1)
+            try:
+                plugin = importlib.import_module(path)
+            except ImportError as e:
+                log.error("Unable to load the %s plugin: %s", path, e)
+                continue
+        fn = getattr(plugin, CALLBACK_PREFIX + name, None)
+        if fn is None:
+            continue
+        meta = getattr(fn, 'command', {})
+        doc = (fn.__doc__ or '').strip().split('\n')[0]
+        reg.register(name, fn, command_nicks.get(name, nicks), doc,
+                     meta.get('kind', 'read'), meta.get('cost', 'cheap'))
+        for sub, opts in meta.get('subcommands', {}).items():
+            reg.register_sub(name, sub, **opts)
+    return reg
@@ -46,10 +46,16 @@ irc = {
     'allowed_nicks': [
         'fmount'
     ],
+    'command_nicks': {
+        'reload': ['fmount'],
+    },
     'log': 'cephbot.log',
     'callback': [
         'hello',
         'help',
+        'stats',
+        'more',
+        'reload',
         'gerrit',
         'guess',
         'squad'
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+
+# Seconds a cached change is served without asking gerrit again
+DEFAULT_TTL = 60
+
+# Max number of changes kept in memory
+DEFAULT_SIZE = 128
+
+log = logging.getLogger(__name__)
+
+
+class ChangeCache(object):
+    '''
+    An in-process LRU cache of change records keyed by change
+    number. A record is served as is until its TTL expires; after
+    that it can be revalidated by comparing its last_updated field
+    with the one currently reported by gerrit.
+    '''
+
+    def __init__(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE, revalidate=True, clock=time.monotonic):
+        self.ttl = ttl
+        self.size = size
+        self.revalidate = revalidate
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'revalidated': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, review):
+        '''
+        Return the record if it's still within its TTL, None
+        otherwise.
+        '''
+        key = str(review)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or self._clock() - entry[0] > self.ttl:
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[1]
+
+    def peek(self, review):
+        '''
+        Return the record regardless of its TTL (or None).
+        '''
+        with self._lock:
+            entry = self._entries.get(str(review), None)
+        return entry[1] if entry is not None else None
+
+    def is_current(self, review, last_updated):
+        '''
+        Check the cached record against the lastUpdated reported
+        by gerrit: if it matches, the entry gets a new TTL.
+        '''
+        key = str(review)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry[1].last_updated != last_updated:
+                return False
+            self._entries[key] = (self._clock(), entry[1])
+            self._entries.move_to_end(key)
+            self._counters['revalidated'] += 1
+            return True
+
+    def put(self, review, record, stale=False):
+        '''
+        Store the record; a stale one (e.g. loaded from disk) is
+        only served after being revalidated.
+        '''
+        key = str(review)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            # never replace a record with an older one
+            if entry is not None and entry[1].last_updated > record.last_updated:
+                return
+            self._entries[key] = (self._clock() - (self.ttl + 1 if stale else 0), record)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+                log.debug("Evicted change %s from the cache", evicted)
+
+    def invalidate(self, review):
+        with self._lock:
+            if self._entries.pop(str(review), None) is not None:
+                self._counters['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._counters)
+            s['entries'] = len(self._entries)
+        return s
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache(conf):
+    '''
+    Return the process wide cache, built according to the
+    (optional) 'cache' section of the gerrit config.
+    '''
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            opts = conf.get('cache', {})
+            _cache = ChangeCache(
+                ttl=int(opts.get('ttl', DEFAULT_TTL)),
+                size=int(opts.get('size', DEFAULT_SIZE)),
+                revalidate=bool(opts.get('revalidate', True)))
+        return _cache
+
+
+def reconfigure(old, new):
+    '''
+    Apply a reloaded gerrit config: the 'cache' settings are changed
+    in place (the entries are kept), unless the records were built
+    for another CI list or history size.
+    '''
+    with _cache_lock:
+        cache = _cache
+    if cache is None:
+        return
+    if old.get('cache', {}) != new.get('cache', {}):
+        opts = new.get('cache', {})
+        cache.ttl = int(opts.get('ttl', DEFAULT_TTL))
+        cache.size = int(opts.get('size', DEFAULT_SIZE))
+        cache.revalidate = bool(opts.get('revalidate', True))
+        log.info("Change cache reconfigured")
+    # the records (comments) were filtered by the old CI list
+    if old.get('allowed_ci') != new.get('allowed_ci') or \
+            old.get('ci_history') != new.get('ci_history'):
+        cache.clear()
+        log.info("Change cache cleared")
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+
+from collections import OrderedDict
+import logging
+import re
+import threading
+
+
+# Number of parsed comments remembered per change
+DEFAULT_PARSED_SIZE = 32
+
+# Patch Set 3: Verified-1
+_HEADER = re.compile(r'^Patch Set (\d+):')
+
+# - <job> <url> : <RESULT> in <duration> (non-voting)
+_JOB = re.compile(r'^( *)- (\S+) (\S+)(?: : ([A-Z_]+))?(?: in ([\dhms ]+?))?( \(non-voting\))?\s*$',
+                  re.MULTILINE)
+
+_DURATION = re.compile(r'(\d+)([hms])')
+_UNITS = {'h': 3600, 'm': 60, 's': 1}
+
+log = logging.getLogger(__name__)
+
+
+class JobResult(object):
+    '''
+    The outcome of a CI job as reported in a CI comment; the
+    duration is in seconds (None if not reported).
+    '''
+    __slots__ = ('name', 'url', 'result', 'duration', 'voting')
+
+    def __init__(self, name, url, result=None, duration=None, voting=True):
+        self.name = name
+        self.url = url
+        self.result = result
+        self.duration = duration
+        self.voting = voting
+
+    @property
+    def failed(self):
+        return self.result is not None and self.result != 'SUCCESS'
+
+    def __str__(self):
+        return '{} {}'.format(self.url, self.result) if self.result else self.url
+
+    def __repr__(self):
+        return 'JobResult({}, {})'.format(self.name, self.result)
+
+
+def parse_duration(text):
+    if not text:
+        return None
+    return sum(int(n) * _UNITS[u] for n, u in _DURATION.findall(text))
+
+
+def parse_comment(message):
+    '''
+    Return the (patchset, {job: JobResult}) found in a CI comment.
+    '''
+    header = _HEADER.match(message)
+    psnum = int(header.group(1)) if header is not None else None
+    jobs = OrderedDict()
+    for indent, name, url, result, duration, nv in _JOB.findall(message):
+        if indent:  # just check the first level
+            raise Exception("unexpected indent")
+        jobs[name] = JobResult(name, url, result or None, parse_duration(duration), not nv)
+    return psnum, jobs
+
+
+class _ChangeIndex(object):
+    __slots__ = ('last_seen', 'parsed', 'patchsets')
+
+    def __init__(self):
+        self.last_seen = None
+        # (timestamp, reviewer) -> (patchset, jobs)
+        self.parsed = OrderedDict()
+        # patchset -> {job: JobResult}, the latest result wins
+        self.patchsets = {}
+
+
+class CIParser(object):
+    '''
+    Parse the CI comments of a change incrementally: the last
+    (timestamp, reviewer) processed is remembered per change, so
+    only the new comments are parsed on each fetch, and their jobs
+    are added to a per patchset index.
+    '''
+
+    def __init__(self, parsed_size=DEFAULT_PARSED_SIZE):
+        self.parsed_size = parsed_size
+        self.parsed = 0
+        self.reused = 0
+        self._changes = {}
+        self._lock = threading.Lock()
+
+    def update(self, change, comments):
+        '''
+        Fill the jobs of the given CI comments (sorted by time),
+        parsing only the ones not seen before, and return the new
+        ones.
+        '''
+        new = []
+        with self._lock:
+            idx = self._changes.setdefault(str(change), _ChangeIndex())
+            for c in comments:
+                key = c.key
+                if key in idx.parsed:
+                    c.patchset, c.jobs = idx.parsed[key]
+                    self.reused += 1
+                    continue
+                c.patchset, c.jobs = parse_comment(c.message)
+                self.parsed += 1
+                idx.parsed[key] = (c.patchset, c.jobs)
+                if len(idx.parsed) > self.parsed_size:
+                    idx.parsed.popitem(last=False)
+                if idx.last_seen is None or key > idx.last_seen:
+                    idx.last_seen = key
+                    new.append(c)
+                    if c.patchset is not None:
+                        idx.patchsets.setdefault(c.patchset, OrderedDict()).update(c.jobs)
+        if new:
+            log.debug("Parsed %d new CI comment(s) for %s", len(new), change)
+        return new
+
+    def jobs(self, change, psnum):
+        '''
+        Return the {job: JobResult} index of a patchset.
+        '''
+        with self._lock:
+            idx = self._changes.get(str(change), None)
+            if idx is None:
+                return {}
+            return dict(idx.patchsets.get(int(psnum), {}))
+
+    def last_seen(self, change):
+        with self._lock:
+            idx = self._changes.get(str(change), None)
+            return idx.last_seen if idx is not None else None
+
+    def forget(self, change):
+        with self._lock:
+            self._changes.pop(str(change), None)
+
+
+_parser = CIParser()
+
+
+def get_parser():
+    return _parser
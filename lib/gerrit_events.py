@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+import json
+import logging
+import threading
+
+from lib import change_cache
+from lib import gerrit_ssh
+from lib import patch_set as ps
+
+
+# The only events we care about
+DEFAULT_EVENTS = ['comment-added', 'patchset-created', 'change-merged']
+
+# Seconds to wait before reconnecting, doubled after each failure
+RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 300
+
+log = logging.getLogger(__name__)
+
+
+def watched_changes(conf):
+    '''
+    Return the submissions configured with the 'watch' action.
+    '''
+    return set(str(r) for r, opts in conf.get('submissions', {}).items()
+               if 'watch' in opts.get('actions', []))
+
+
+class _SSHEventSource(object):
+    '''
+    Run 'gerrit stream-events' on a single channel of the
+    pooled transports and iterate over the received lines.
+    '''
+
+    def __init__(self, conf, events):
+        self.conf = conf
+        self.cmd = 'gerrit stream-events {}'.format(
+            ' '.join('-s {}'.format(e) for e in events))
+        self._pool = gerrit_ssh.get_pool(conf)
+        self._conn = None
+        self._chan = None
+
+    def __iter__(self):
+        self._conn, self._chan = self._pool.open_channel(self.conf)
+        self._chan.exec_command(self.cmd)
+        return iter(self._chan.makefile('r'))
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn, self._chan)
+            self._conn = self._chan = None
+
+
+class EventStream(object):
+    '''
+    A long lived subscriber of the gerrit event stream: events
+    related to the watched changes update the local state and are
+    announced using the provided callable.
+    '''
+
+    def __init__(self, conf, announce, watched=None, source=None, resync=None):
+        '''
+        :param announce is called with the message to post
+        :param watched is the set of changes to follow (default: the
+            submissions with the 'watch' action)
+        :param source is a factory returning an iterable of event lines
+            (with an optional close()), default: gerrit stream-events
+        :param resync is called with the watched changes after each
+            (re)connection and returns {change: record}, default: a
+            batch gerrit query
+        '''
+        opts = conf.get('stream', {})
+        self.conf = conf
+        self.announce = announce
+        self.watched = set(watched) if watched is not None else watched_changes(conf)
+        self.events = opts.get('events', DEFAULT_EVENTS)
+        self.reconnect_delay = opts.get('reconnect_delay', RECONNECT_DELAY)
+        self.max_reconnect_delay = opts.get('max_reconnect_delay', MAX_RECONNECT_DELAY)
+        self.state = {}
+
+        self._source = source if source is not None else \
+            (lambda: _SSHEventSource(self.conf, self.events))
+        self._resync = resync if resync is not None else self._query
+        self._current = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def update(self, conf):
+        '''
+        Follow the watched changes of a new config (their state is
+        built by the next events, or resync).
+        '''
+        self.conf = conf
+        self.watched = watched_changes(conf)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='gerrit-events', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._close()
+
+    def _close(self):
+        current, self._current = self._current, None
+        if current is not None and hasattr(current, 'close'):
+            current.close()
+
+    def _query(self, changes):
+        return ps.query_changes(self.conf, changes)
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self._stop.is_set():
+            try:
+                self._current = self._source()
+                lines = iter(self._current)
+                # subscribed: catch up with what happened while we
+                # were not listening
+                self.resync()
+                for line in lines:
+                    if self._stop.is_set():
+                        break
+                    delay = self.reconnect_delay
+                    self.handle_line(line)
+                log.info("Gerrit event stream closed")
+            except Exception as e:
+                log.warning("Gerrit event stream failed: %s", e)
+            finally:
+                self._close()
+            if self._stop.wait(delay):
+                break
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def resync(self):
+        '''
+        Refresh the state of the watched changes; differences with
+        the previous state are announced as they were events.
+        '''
+        if not self.watched:
+            return
+        for change, record in self._resync(sorted(self.watched)).items():
+            self._update(str(change), record.current_patch_set.number,
+                         record.status, record.last_updated)
+
+    def handle_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            event = json.loads(line)
+        except ValueError:
+            log.debug("Ignoring malformed event: %s", line)
+            return
+        self.handle_event(event)
+
+    def handle_event(self, event):
+        etype = event.get('type')
+        change = str(event.get('change', {}).get('number', ''))
+        if etype not in self.events or change not in self.watched:
+            return
+
+        psnum = event.get('patchSet', {}).get('number')
+        ts = event.get('eventCreatedOn')
+        change_cache.get_cache(self.conf).invalidate(change)
+
+        if etype == 'comment-added':
+            self._update(change, psnum, None, ts, announce=False)
+            msg = self._format_comment(change, psnum, event)
+            if msg is not None:
+                self.announce(msg)
+        elif etype == 'patchset-created':
+            self._update(change, psnum, 'NEW', ts)
+        elif etype == 'change-merged':
+            self._update(change, psnum, 'MERGED', ts)
+
+    def _update(self, change, psnum, status, last_updated, announce=True):
+        '''
+        Merge the new information into the state of the change and
+        announce a new patchset or a status change.
+        '''
+        prev = self.state.get(change, None)
+        cur = dict(prev) if prev is not None else {}
+        if psnum is not None:
+            cur['patchset'] = int(psnum)
+        if status is not None:
+            cur['status'] = status
+        if last_updated is not None:
+            cur['lastUpdated'] = last_updated
+        self.state[change] = cur
+
+        if not announce or prev is None:
+            return
+        if cur.get('status') != prev.get('status') and cur.get('status') == 'MERGED':
+            self.announce('Review {} has been merged'.format(change))
+        elif cur.get('patchset', 0) > prev.get('patchset', 0):
+            self.announce('Review {}: new patch set {} uploaded'.format(change, cur['patchset']))
+
+    def _format_comment(self, change, psnum, event):
+        author = event.get('author', {}).get('name', '')
+        votes = ['{}{:+d}'.format(a.get('type'), int(a.get('value', 0)))
+                 for a in event.get('approvals', []) if 'oldValue' in a]
+        if author not in self.conf.get('allowed_ci', []) and not votes:
+            return None
+        # the first line after the header holds the verdict
+        # (e.g. Build failed (check pipeline).  For information ...)
+        lines = [x for x in event.get('comment', '').split('\n')[1:] if x.strip()]
+        verdict = lines[0].split('. ')[0].strip() if lines else ''
+        return 'Review {} PS {}: {} {} {}'.format(
+            change, psnum, author, ' '.join(votes), verdict).strip()
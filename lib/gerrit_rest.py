@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+import base64
+import calendar
+from collections import OrderedDict
+import json
+import logging
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+from lib import http_pool
+from lib import metrics
+from lib import query_decoder
+
+
+# Options of the change queries: the comment history (MESSAGES) is
+# only asked for when it's needed
+OPTIONS = ['CURRENT_REVISION', 'DETAILED_LABELS', 'DETAILED_ACCOUNTS']
+COMMENT_OPTIONS = ['MESSAGES']
+
+# Changes whose last response (and ETag) is kept to be revalidated
+ETAG_CACHE_SIZE = 256
+
+# The prefix gerrit puts in front of each JSON response
+_MAGIC = b")]}'"
+
+log = logging.getLogger(__name__)
+
+
+def _timestamp(date):
+    '''
+    '2021-03-10 15:21:39.000000000' (UTC) to seconds since the epoch,
+    as reported by the ssh queries.
+    '''
+    return calendar.timegm(time.strptime(date[:19], '%Y-%m-%d %H:%M:%S'))
+
+
+def _label(name):
+    # code-review -> Code-Review
+    return '-'.join(p.capitalize() for p in name.split('-'))
+
+
+class GerritREST(object):
+    '''
+    Talk to gerrit through its REST API over pooled keep-alive
+    connections. The changes are returned as the rows of the ssh
+    query output, so both backends build the same records.
+    A single change is fetched with If-None-Match: when it didn't
+    change, gerrit answers 304 and the last response is reused.
+    '''
+
+    def __init__(self, url, user=None, password=None, pool_size=http_pool.POOL_SIZE,
+                 timeout=http_pool.TIMEOUT, etag_size=ETAG_CACHE_SIZE):
+        self.url = url.rstrip('/')
+        self.etag_size = etag_size
+        self.pool = http_pool.HTTPPool(size=pool_size, timeout=timeout)
+        self._headers = {'Accept': 'application/json'}
+        # authenticated requests go through the /a/ endpoints
+        self._prefix = ''
+        if password:
+            token = base64.b64encode('{}:{}'.format(user, password).encode()).decode()
+            self._headers['Authorization'] = 'Basic ' + token
+            self._prefix = '/a'
+        # (change, options, allowed_ci, keep) -> (etag, row)
+        self._etags = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'requests': 0,
+            'not_modified': 0,
+        }
+
+    def _call(self, method, path, body=None, etag=None):
+        '''
+        Return the status, the ETag and the (JSON decoded, if
+        successful) body of the response.
+        '''
+        headers = dict(self._headers)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        with self._lock:
+            self._counters['requests'] += 1
+        key, conn, resp = self.pool.request(self.url + self._prefix + path, headers, method, body)
+        try:
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.release(key, conn)
+
+        if resp.status >= 300:
+            return resp.status, None, data.decode('utf-8', 'replace').strip()
+        if data.startswith(_MAGIC):
+            data = data[len(_MAGIC):]
+        return resp.status, resp.getheader('ETag', None), json.loads(data) if data.strip() else None
+
+    def _options(self, args):
+        options = list(OPTIONS)
+        if args is not None and 'comments' in args:
+            options += COMMENT_OPTIONS
+        return options
+
+    def query(self, changes, args=None, allowed_ci=None, keep=query_decoder.DEFAULT_CI_HISTORY):
+        '''
+        Return the rows of the given changes, like a gerrit query
+        with --current-patch-set (and --comments, if in args): only
+        the last `keep` comments of the allowed CI(s) are kept.
+        '''
+        options = self._options(args)
+        allowed_ci = frozenset(allowed_ci) if allowed_ci is not None else None
+        if len(changes) == 1:
+            row = self._get(str(changes[0]), options, allowed_ci, keep)
+            return [row] if row is not None else []
+
+        params = [('q', ' OR '.join('change:{}'.format(c) for c in changes)),
+                  ('n', len(changes))] + [('o', o) for o in options]
+        with metrics.span('gerrit_rest', kind='query'):
+            status, _, out = self._call('GET', '/changes/?' + urlencode(params))
+        if status != 200:
+            raise Exception("Gerrit query failed: HTTP {} {}".format(status, out))
+        if out and out[-1].get('_more_changes', False):
+            log.warning("Gerrit truncated the result of a batch query")
+        return [self._to_row(info, allowed_ci, keep) for info in out or []]
+
+    def _get(self, change, options, allowed_ci, keep):
+        key = (change, tuple(options), allowed_ci, keep)
+        with self._lock:
+            cached = self._etags.get(key, None)
+        path = '/changes/{}?{}'.format(quote(change), urlencode([('o', o) for o in options]))
+        with metrics.span('gerrit_rest', kind='get'):
+            status, etag, out = self._call('GET', path,
+                                           etag=cached[0] if cached is not None else None)
+        if status == 304 and cached is not None:
+            log.debug("Change %s not modified", change)
+            with self._lock:
+                self._counters['not_modified'] += 1
+                self._etags.move_to_end(key)
+            return cached[1]
+        if status == 404:
+            return None
+        if status != 200:
+            raise Exception("Gerrit query failed: HTTP {} {}".format(status, out))
+
+        row = self._to_row(out, allowed_ci, keep)
+        if etag is not None:
+            with self._lock:
+                self._etags[key] = (etag, row)
+                self._etags.move_to_end(key)
+                while len(self._etags) > self.etag_size:
+                    self._etags.popitem(last=False)
+        return row
+
+    def _to_row(self, info, allowed_ci, keep):
+        '''
+        A ChangeInfo as a row of the ssh query output.
+        '''
+        current = info.get('current_revision', '')
+        rev = info.get('revisions', {}).get(current, {})
+        approvals = []
+        for label, votes in info.get('labels', {}).items():
+            for v in votes.get('all', []):
+                # reviewers who can vote but didn't are listed with 0
+                if v.get('value', 0):
+                    approvals.append({'type': label, 'value': v['value'],
+                                      'grantedOn': _timestamp(v['date']) if 'date' in v else 0,
+                                      'by': {'name': v.get('name', v.get('username', ''))}})
+        ps = {'number': rev.get('_number', 0), 'kind': rev.get('kind', ''), 'revision': current}
+        if approvals:
+            ps['approvals'] = approvals
+
+        row = {
+            'number': info['_number'],
+            'project': info.get('project', ''),
+            'branch': info.get('branch', ''),
+            'subject': info.get('subject', ''),
+            'url': '{}/c/{}/+/{}'.format(self.url, info.get('project', ''), info['_number']),
+            'status': info.get('status', ''),
+            'lastUpdated': _timestamp(info['updated']) if 'updated' in info else 0,
+            'currentPatchSet': ps,
+        }
+        if 'messages' in info:
+            # the same history the ssh query decoder keeps: the last
+            # comments of the allowed CI(s)
+            comments = []
+            for m in info['messages']:
+                name = m.get('author', {}).get('name', '')
+                if allowed_ci is None or name in allowed_ci:
+                    comments.append({'timestamp': _timestamp(m['date']),
+                                     'reviewer': {'name': name},
+                                     'message': m.get('message', '')})
+            row['comments'] = comments[-keep:] if keep else comments
+        return row
+
+    def review(self, change, psnum, args=None, **kwargs):
+        '''
+        Same as 'gerrit review' (args can contain 'rebase'): return
+        the error lines, empty on success.
+        '''
+        revision = psnum
+        if args is not None and 'rebase' in args:
+            with metrics.span('gerrit_rest', kind='rebase'):
+                status, _, out = self._call(
+                    'POST', '/changes/{}/revisions/{}/rebase'.format(change, psnum), {})
+            if status != 200:
+                return ['fatal: {}'.format(out)]
+            revision = 'current'
+
+        body = {}
+        labels = dict((_label(k), v) for k, v in kwargs.items() if isinstance(v, int))
+        if labels:
+            body['labels'] = labels
+        if 'message' in kwargs:
+            body['message'] = kwargs['message']
+        if not body:
+            return []
+        with metrics.span('gerrit_rest', kind='review'):
+            status, _, out = self._call(
+                'POST', '/changes/{}/revisions/{}/review'.format(change, revision), body)
+        if status != 200:
+            return ['fatal: {}'.format(out)]
+        return []
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._counters)
+            s['etags'] = len(self._etags)
+        return s
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(conf):
+    '''
+    Return the process wide client, built according to the 'http'
+    section of the gerrit config.
+    '''
+    global _client
+    with _client_lock:
+        if _client is None:
+            opts = conf.get('http', {})
+            _client = GerritREST(opts.get('url', 'https://{}'.format(conf['instance'])),
+                                 user=conf.get('user', {}).get('name', None),
+                                 password=opts.get('password', None),
+                                 pool_size=int(opts.get('pool_size', http_pool.POOL_SIZE)),
+                                 timeout=opts.get('timeout', http_pool.TIMEOUT),
+                                 etag_size=int(opts.get('etag_cache', ETAG_CACHE_SIZE)))
+        return _client
+
+
+def reconfigure(old, new):
+    '''
+    Apply a reloaded gerrit config: the client is built again on
+    the next use if its url or credentials changed.
+    '''
+    global _client
+    if all(old.get(k) == new.get(k) for k in ('http', 'instance', 'user')):
+        return
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.pool.close()
+        log.info("Gerrit REST client dropped, the next one uses the new settings")
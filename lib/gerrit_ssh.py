@@ -0,0 +1,364 @@
+#!/usr/bin/python
+
+import paramiko
+import codecs
+import logging
+import os
+import socket
+import threading
+import time
+
+from lib import metrics
+
+
+# Seconds between two keepalive packets sent on an idle transport
+DEFAULT_KEEPALIVE = 30
+
+# A transport nobody used for this amount of seconds is closed
+DEFAULT_IDLE_TIMEOUT = 300
+
+# Max number of authenticated transports kept open per gerrit instance
+DEFAULT_MAX_TRANSPORTS = 2
+
+# Number of concurrent exec channels we open on a transport before
+# considering a new one
+DEFAULT_MAX_CHANNELS = 4
+
+CONNECT_TIMEOUT = 10
+
+# Bytes read from a channel at once when streaming the output
+CHUNK_SIZE = 32768
+
+log = logging.getLogger(__name__)
+
+
+class CommandError(Exception):
+    '''
+    A gerrit command wrote on stderr: stderr is the text, as is.
+    '''
+
+    def __init__(self, stderr):
+        super(CommandError, self).__init__("Gerrit command failed: %s" % stderr.strip())
+        self.stderr = stderr
+
+
+class _Connection(object):
+    '''
+    An authenticated transport and the bookkeeping needed
+    to share it between commands.
+    '''
+    __slots__ = ('transport', 'in_use', 'last_used')
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+    def alive(self):
+        return self.transport.is_active() and self.transport.is_authenticated()
+
+    def close(self):
+        try:
+            self.transport.close()
+        except Exception:
+            pass
+
+
+class SSHConnectionPool(object):
+    '''
+    Keep authenticated paramiko transports open against the
+    gerrit instance(s) and open a new exec channel on one of
+    them for each command, instead of building a new SSHClient
+    (and doing a full handshake) every time.
+    '''
+
+    def __init__(self,
+                 keepalive=DEFAULT_KEEPALIVE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_transports=DEFAULT_MAX_TRANSPORTS,
+                 max_channels=DEFAULT_MAX_CHANNELS):
+
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.max_transports = max_transports
+        self.max_channels = max_channels
+
+        self._keys = {}
+        self._conns = {}
+        self._connecting = {}
+        self._host_keys = None
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._reaper = None
+
+    def _target(self, conf):
+        return (conf['instance'], int(conf['port']), conf['user']['name'])
+
+    def _load_key(self, path):
+        '''
+        The private key is parsed only once, the first time a
+        transport is built against an instance.
+        '''
+        path = os.path.expanduser(path)
+        if path not in self._keys:
+            self._keys[path] = paramiko.RSAKey(filename=path)
+        return self._keys[path]
+
+    def _check_host_key(self, host, port, key):
+        '''
+        Same policy we had with the SSHClient: system host keys
+        are loaded and unknown hosts are accepted, but a known
+        host presenting a different key is rejected.
+        '''
+        if self._host_keys is None:
+            self._host_keys = paramiko.HostKeys()
+            try:
+                self._host_keys.load(os.path.expanduser('~/.ssh/known_hosts'))
+            except IOError:
+                pass
+
+        name = host if port == 22 else '[{}]:{}'.format(host, port)
+        known = self._host_keys.lookup(name)
+        if known is not None and key.get_name() in known:
+            if known[key.get_name()] != key:
+                raise paramiko.BadHostKeyException(host, key, known[key.get_name()])
+            return
+        self._host_keys.add(name, key.get_name(), key)
+
+    def _auth(self, transport, user, pkey):
+        try:
+            transport.auth_publickey(user, pkey)
+            return
+        except paramiko.SSHException as e:
+            log.debug("Key based auth failed for %s: %s", user, e)
+
+        # fallback to the agent, as allow_agent=True used to do
+        for agent_key in paramiko.Agent().get_keys():
+            try:
+                transport.auth_publickey(user, agent_key)
+                return
+            except paramiko.SSHException:
+                continue
+        raise paramiko.AuthenticationException("Unable to authenticate %s" % user)
+
+    def _connect(self, conf):
+        host, port, user = self._target(conf)
+        pkey = self._load_key(conf['user']['key'])
+
+        log.debug("Opening a new transport to %s:%d", host, port)
+        with metrics.span('ssh_connect'):
+            sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+            transport = paramiko.Transport(sock)
+            try:
+                transport.start_client(timeout=CONNECT_TIMEOUT)
+                self._check_host_key(host, port, transport.get_remote_server_key())
+                self._auth(transport, user, pkey)
+            except Exception:
+                transport.close()
+                raise
+        transport.set_keepalive(self.keepalive)
+        return _Connection(transport)
+
+    def _acquire(self, conf):
+        target = self._target(conf)
+        with self._lock:
+            while True:
+                conns = self._conns.setdefault(target, [])
+
+                # get rid of the transports that dropped in the meantime
+                for conn in [x for x in conns if not x.alive()]:
+                    log.debug("Transport to %s:%d dropped", target[0], target[1])
+                    conns.remove(conn)
+                    conn.close()
+
+                # transports being built count against max_transports
+                connecting = self._connecting.get(target, 0)
+                best = min(conns, key=lambda x: x.in_use, default=None)
+                if best is not None and (best.in_use < self.max_channels or
+                                         len(conns) + connecting >= self.max_transports):
+                    best.in_use += 1
+                    return best
+                if len(conns) + connecting < self.max_transports:
+                    break
+                # nothing usable yet: wait for a handshake in progress
+                self._ready.wait()
+            self._connecting[target] = connecting + 1
+
+        # the handshake happens outside the lock, so other commands
+        # can still use the transports already available
+        conn = None
+        try:
+            conn = self._connect(conf)
+            conn.in_use = 1
+        finally:
+            with self._lock:
+                self._connecting[target] -= 1
+                if conn is not None:
+                    self._conns.setdefault(target, []).append(conn)
+                self._ready.notify_all()
+        self._start_reaper()
+        return conn
+
+    def _release(self, conn):
+        with self._lock:
+            conn.in_use -= 1
+            conn.last_used = time.monotonic()
+
+    def _discard(self, conf, conn):
+        with self._lock:
+            conns = self._conns.get(self._target(conf), [])
+            if conn in conns:
+                conns.remove(conn)
+        conn.close()
+
+    def open_channel(self, conf):
+        '''
+        Return a (connection, channel) pair: the channel is opened
+        on an existing transport if available, and a broken transport
+        is replaced once before giving up.
+        The caller is supposed to hand the connection back using
+        release().
+        '''
+        for attempt in range(2):
+            conn = self._acquire(conf)
+            try:
+                return conn, conn.transport.open_session(timeout=CONNECT_TIMEOUT)
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                log.debug("Unable to open a channel (%s), reconnecting", e)
+                self._release(conn)
+                self._discard(conf, conn)
+                if attempt:
+                    raise
+
+    def release(self, conn, channel=None):
+        if channel is not None:
+            channel.close()
+        self._release(conn)
+
+    def exec_command(self, conf, cmd):
+        '''
+        Run cmd on a pooled transport and return the
+        (stdout, stderr) lines.
+        '''
+        start = time.perf_counter()
+        conn, chan = self.open_channel(conf)
+        try:
+            chan.exec_command(cmd)
+            metrics.observe(metrics.SPAN, time.perf_counter() - start, stage='ssh_exec')
+            with metrics.span('ssh_read'):
+                stdout = chan.makefile('r')
+                stderr = chan.makefile_stderr('r')
+                payload = stdout.readlines()
+                perr = stderr.readlines()
+        finally:
+            self.release(conn, chan)
+        return payload, perr
+
+    def stream_command(self, conf, cmd, size=CHUNK_SIZE):
+        '''
+        Run cmd on a pooled transport and yield its stdout as
+        text chunks, as they are received; whatever the command
+        writes on stderr is raised once stdout is over.
+        '''
+        start = time.perf_counter()
+        conn, chan = self.open_channel(conf)
+        try:
+            chan.exec_command(cmd)
+            metrics.observe(metrics.SPAN, time.perf_counter() - start, stage='ssh_exec')
+
+            # only the time spent waiting for data is accounted as read
+            reading = 0.0
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+            while True:
+                start = time.perf_counter()
+                data = chan.recv(size)
+                reading += time.perf_counter() - start
+                if not data:
+                    break
+                yield decoder.decode(data)
+            metrics.observe(metrics.SPAN, reading, stage='ssh_read')
+            tail = decoder.decode(b'', True)
+            if tail:
+                yield tail
+            perr = chan.makefile_stderr('r').read()
+            if perr:
+                perr = perr.decode('utf-8', 'replace') if isinstance(perr, bytes) else perr
+                raise CommandError(perr)
+        finally:
+            self.release(conn, chan)
+
+    def close_idle(self):
+        '''
+        Close the transports not used for more than idle_timeout.
+        '''
+        now = time.monotonic()
+        idle = []
+        with self._lock:
+            for target, conns in self._conns.items():
+                for conn in list(conns):
+                    if conn.in_use == 0 and now - conn.last_used > self.idle_timeout:
+                        conns.remove(conn)
+                        idle.append((target, conn))
+        for target, conn in idle:
+            log.debug("Closing idle transport to %s:%d", target[0], target[1])
+            conn.close()
+
+    def close(self):
+        with self._lock:
+            conns = [x for c in self._conns.values() for x in c]
+            self._conns = {}
+        for conn in conns:
+            conn.close()
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap, name='ssh-reaper', daemon=True)
+        self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2))
+            self.close_idle()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(conf):
+    '''
+    Return the process wide pool, built according to the
+    (optional) 'ssh' section of the gerrit config.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            opts = conf.get('ssh', {})
+            _pool = SSHConnectionPool(
+                keepalive=int(opts.get('keepalive', DEFAULT_KEEPALIVE)),
+                idle_timeout=int(opts.get('idle_timeout', DEFAULT_IDLE_TIMEOUT)),
+                max_transports=int(opts.get('max_transports', DEFAULT_MAX_TRANSPORTS)),
+                max_channels=int(opts.get('max_channels', DEFAULT_MAX_CHANNELS)))
+        return _pool
+
+
+def reconfigure(old, new):
+    '''
+    Apply a reloaded gerrit config: the 'ssh' settings are changed
+    in place, so the open transports (and the event stream using
+    them) are kept; the new ones get the new keepalive. A new
+    instance, port or user just gets its own transports.
+    '''
+    with _pool_lock:
+        if _pool is None or old.get('ssh', {}) == new.get('ssh', {}):
+            return
+        opts = new.get('ssh', {})
+        with _pool._lock:
+            _pool.keepalive = int(opts.get('keepalive', DEFAULT_KEEPALIVE))
+            _pool.idle_timeout = int(opts.get('idle_timeout', DEFAULT_IDLE_TIMEOUT))
+            _pool.max_transports = int(opts.get('max_transports', DEFAULT_MAX_TRANSPORTS))
+            _pool.max_channels = int(opts.get('max_channels', DEFAULT_MAX_CHANNELS))
+            _pool._ready.notify_all()
+    log.info("SSH pool reconfigured")
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+import http.client
+import threading
+from urllib.parse import urlsplit
+
+
+# Idle keep-alive connections kept for each host
+POOL_SIZE = 4
+
+# Seconds a request can take
+TIMEOUT = 20
+
+
+class HTTPPool(object):
+    '''
+    A minimal pool of keep-alive http(s) connections: a connection
+    is reused by the next request to the same host once the previous
+    response has been fully read.
+    '''
+
+    def __init__(self, size=POOL_SIZE, timeout=TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, key):
+        '''
+        Return an idle connection (and True) if there's one, a new
+        one (and False) otherwise.
+        '''
+        with self._lock:
+            idle = self._idle.get(key, [])
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _connect(self, key):
+        scheme, host, port = key
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return cls(host, port, timeout=self.timeout)
+
+    def release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url, headers=None, method='GET', body=None):
+        '''
+        Send a request: return the pool key, the connection and the
+        response, to be read and then release()d.
+        '''
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn, reused = self._acquire(key)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            return key, conn, conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if not reused:
+                raise
+        # the server closed the idle keep-alive connection: retry
+        # once on a new one
+        conn = self._connect(key)
+        conn.request(method, path, body=body, headers=headers or {})
+        return key, conn, conn.getresponse()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for c in conns:
+                c.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+from array import array
+from collections import deque
+import logging
+import threading
+
+
+# Default flaky settings (see the 'flaky' section of the gerrit
+# config): CI comments kept for each change, and offenders reported
+WINDOW = 50
+TOP = 5
+
+# Recent runs compared with the older ones to tell the duration trend
+TREND_RUNS = 3
+
+log = logging.getLogger(__name__)
+
+
+class JobStats(object):
+    '''
+    What the history tells about a job: rechecks are the runs on a
+    patchset already tested, flips the patchsets where the job both
+    failed and passed (the same code, a different outcome).
+    '''
+    __slots__ = ('name', 'runs', 'failures', 'rechecks', 'flips', 'duration', 'trend')
+
+    def __init__(self, name, runs=0, failures=0, rechecks=0, flips=0):
+        self.name = name
+        self.runs = runs
+        self.failures = failures
+        self.rechecks = rechecks
+        self.flips = flips
+        # average and (recent vs older) change, in seconds
+        self.duration = None
+        self.trend = None
+
+    @property
+    def failure_rate(self):
+        return float(self.failures) / self.runs if self.runs else 0.0
+
+    def __repr__(self):
+        return 'JobStats({}, {}/{})'.format(self.name, self.failures, self.runs)
+
+
+class _ChangeHistory(object):
+    '''
+    The job runs of a change as columns, oldest first, and the per
+    job counters kept up to date as runs are added and evicted.
+    '''
+    __slots__ = ('job', 'patchset', 'timestamp', 'failed', 'duration',
+                 'comments', 'seen', 'last_seen', 'buckets', 'counters')
+
+    def __init__(self):
+        self.job = array('I')
+        self.patchset = array('I')
+        self.timestamp = array('q')
+        self.failed = array('b')
+        # -1 if not reported
+        self.duration = array('l')
+        # (key, rows added) of each comment in the window
+        self.comments = deque()
+        self.seen = set()
+        self.last_seen = None
+        # (job, patchset) -> [runs, failed, passed]
+        self.buckets = {}
+        # job -> [runs, failures, rechecks, flips]
+        self.counters = {}
+
+    def _count(self, job, psnum, failed, sign):
+        b = self.buckets.setdefault((job, psnum), [0, 0, 0])
+        rechecks, flips = max(0, b[0] - 1), int(bool(b[1] and b[2]))
+        b[0] += sign
+        b[1 if failed else 2] += sign
+        c = self.counters.setdefault(job, [0, 0, 0, 0])
+        c[0] += sign
+        c[1] += sign if failed else 0
+        c[2] += max(0, b[0] - 1) - rechecks
+        c[3] += int(bool(b[1] and b[2])) - flips
+        if b[0] == 0:
+            del self.buckets[(job, psnum)]
+        if c[0] == 0:
+            del self.counters[job]
+
+    def add(self, job, psnum, timestamp, failed, duration):
+        self.job.append(job)
+        self.patchset.append(psnum)
+        self.timestamp.append(timestamp)
+        self.failed.append(failed)
+        self.duration.append(duration if duration is not None else -1)
+        self._count(job, psnum, failed, 1)
+
+    def evict(self, rows):
+        for i in range(rows):
+            self._count(self.job[i], self.patchset[i], self.failed[i], -1)
+        for col in (self.job, self.patchset, self.timestamp, self.failed, self.duration):
+            del col[:rows]
+
+    def durations(self, job):
+        return [d for j, d in zip(self.job, self.duration) if j == job and d >= 0]
+
+
+class JobHistory(object):
+    '''
+    The CI job runs of the last `window` CI comments of each change,
+    fed incrementally with the (already parsed) comments: only the
+    ones not seen yet are added. Comments older than the last seen
+    mean a wider window than the one known: the history of the
+    change is built again out of it.
+    '''
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._names = []
+        self._ids = {}
+        self._changes = {}
+        self._lock = threading.Lock()
+
+    def _intern(self, name):
+        i = self._ids.get(name, None)
+        if i is None:
+            i = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return i
+
+    def add(self, change, comments):
+        '''
+        Add the job runs of the given CI comments (sorted by time,
+        with their jobs filled by the ci_parser).
+        '''
+        # only the last `window` ones would be kept anyway
+        comments = [c for c in comments if c.jobs is not None and c.patchset is not None]
+        comments = comments[-self.window:]
+        added = 0
+        with self._lock:
+            h = self._changes.setdefault(str(change), _ChangeHistory())
+            new = [c for c in comments if c.key not in h.seen]
+            if new and h.last_seen is not None and new[0].key < h.last_seen:
+                log.debug("Wider CI history for %s, counting it again", change)
+                h = self._changes[str(change)] = _ChangeHistory()
+                new = comments
+            for c in new:
+                h.last_seen = max(h.last_seen, c.key) if h.last_seen is not None else c.key
+                rows = 0
+                for job in c.jobs.values():
+                    # still running, or not reported
+                    if job.result is None:
+                        continue
+                    h.add(self._intern(job.name), c.patchset, c.timestamp, job.failed, job.duration)
+                    rows += 1
+                h.comments.append((c.key, rows))
+                h.seen.add(c.key)
+                added += 1
+                while len(h.comments) > self.window:
+                    key, rows = h.comments.popleft()
+                    h.seen.discard(key)
+                    h.evict(rows)
+        if added:
+            log.debug("Added %d CI comment(s) of %s to the job history", added, change)
+        return added
+
+    def stats(self, changes):
+        '''
+        Return the JobStats of the jobs run on the given changes.
+        '''
+        out = {}
+        with self._lock:
+            histories = [self._changes[str(c)] for c in changes if str(c) in self._changes]
+            for h in histories:
+                for job, (runs, failures, rechecks, flips) in h.counters.items():
+                    s = out.get(job, None)
+                    if s is None:
+                        s = out[job] = JobStats(self._names[job])
+                    s.runs += runs
+                    s.failures += failures
+                    s.rechecks += rechecks
+                    s.flips += flips
+            for job, s in out.items():
+                durations = [d for h in histories for d in h.durations(job)]
+                if durations:
+                    s.duration = sum(durations) / len(durations)
+                if len(durations) > TREND_RUNS:
+                    recent, older = durations[-TREND_RUNS:], durations[:-TREND_RUNS]
+                    s.trend = sum(recent) / len(recent) - sum(older) / len(older)
+        return list(out.values())
+
+    def top(self, changes, n=TOP):
+        '''
+        The n jobs most likely to be flaky: the ones flipping on the
+        same patchset first, then the ones failing more often.
+        '''
+        offenders = [s for s in self.stats(changes) if s.failures]
+        offenders.sort(key=lambda s: (s.flips, s.failure_rate, s.failures), reverse=True)
+        return offenders[:n]
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history(conf):
+    '''
+    Return the process wide job history, sized according to the
+    'flaky' section of the gerrit config.
+    '''
+    global _history
+    with _history_lock:
+        if _history is None:
+            _history = JobHistory(int(conf.get('flaky', {}).get('window', WINDOW)))
+        return _history
+
+
+def reconfigure(old, new):
+    '''
+    Apply a reloaded gerrit config: the history is started again if
+    the window or the CI list changed (it's fed back by the next
+    flaky query).
+    '''
+    global _history
+    if old.get('flaky', {}).get('window') == new.get('flaky', {}).get('window') and \
+            old.get('allowed_ci') == new.get('allowed_ci'):
+        return
+    with _history_lock:
+        if _history is not None:
+            _history = None
+            log.info("Job history dropped, the next one uses the new settings")
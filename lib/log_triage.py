@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import re
+import threading
+
+from lib import http_pool
+
+
+# Default triage settings (see the 'triage' section of the gerrit
+# config): the log fetched for each job (relative to the job url),
+# how much of its tail is read, how many logs are fetched at the same
+# time and how long (in seconds) the whole triage can take
+LOG_PATH = 'job-output.txt'
+TAIL_BYTES = 64 * 1024
+WORKERS = 8
+TIMEOUT = 20
+
+# Triaged logs remembered (the log of a finished job doesn't change)
+CACHE_SIZE = 256
+
+# Size of the chunks a response is streamed by
+CHUNK = 8 * 1024
+
+# Lines worth reporting, the first match wins
+SIGNATURES = [
+    r'FAILED!',
+    r'fatal: \[',
+    r'Traceback \(most recent call last\)',
+    r'\b(ERROR|Error):',
+    r'Timeout|timed out',
+]
+
+log = logging.getLogger(__name__)
+
+
+class Triage(object):
+    '''
+    Look for the reason of a CI failure: the tail of the log of
+    each failed job is fetched (concurrently, with a Range request)
+    and the first line matching a failure signature is reported.
+    '''
+
+    def __init__(self, log_path=LOG_PATH, tail_bytes=TAIL_BYTES, workers=WORKERS,
+                 timeout=TIMEOUT, signatures=SIGNATURES, rewrite=None,
+                 cache_size=CACHE_SIZE, pool=None):
+        self.log_path = log_path
+        self.tail_bytes = tail_bytes
+        self.timeout = timeout
+        self.signatures = re.compile('|'.join('(?:{})'.format(s) for s in signatures))
+        self.rewrite = rewrite or {}
+        self.cache_size = cache_size
+        self.pool = pool or http_pool.HTTPPool(timeout=timeout)
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='cephbot-triage')
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'fetched': 0,
+            'bytes': 0,
+            'hits': 0,
+            'errors': 0,
+        }
+
+    def log_url(self, job_url):
+        for prefix, replacement in self.rewrite.items():
+            if job_url.startswith(prefix):
+                job_url = replacement + job_url[len(prefix):]
+                break
+        return job_url.rstrip('/') + '/' + self.log_path
+
+    def triage(self, jobs):
+        '''
+        Return a dict mapping the name of each (failed) job to the
+        first error line found in its log; the jobs whose log can't
+        be fetched within the timeout map to None.
+        '''
+        out = {}
+        futures = {}
+        for job in jobs:
+            url = self.log_url(job.url)
+            with self._lock:
+                cached = url in self._cache
+                if cached:
+                    self._cache.move_to_end(url)
+                    self._counters['hits'] += 1
+                    out[job.name] = self._cache[url]
+            if not cached:
+                futures[self._executor.submit(self._fetch, url)] = (job.name, url)
+
+        done, not_done = wait(futures, self.timeout)
+        for f in done:
+            name, url = futures[f]
+            try:
+                out[name] = f.result()
+            except Exception as e:
+                log.warning("Unable to fetch %s: %s", url, e)
+                with self._lock:
+                    self._counters['errors'] += 1
+                out[name] = None
+                continue
+            with self._lock:
+                self._cache[url] = out[name]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        for f in not_done:
+            f.cancel()
+            out[futures[f][0]] = None
+        return out
+
+    def _fetch(self, url):
+        key, conn, resp = self.pool.request(
+            url, {'Range': 'bytes=-{}'.format(self.tail_bytes)})
+        if resp.status not in (200, 206):
+            resp.read()
+            self.pool.release(key, conn)
+            raise Exception('HTTP {} {}'.format(resp.status, resp.reason))
+
+        if resp.status == 200:
+            log.debug("No range support for %s", url)
+            found, read = self._match_tail(resp)
+        else:
+            found, read = self._match_stream(resp)
+
+        with self._lock:
+            self._counters['fetched'] += 1
+            self._counters['bytes'] += read
+        # the connection can be reused only if the response was read
+        # till the end
+        if resp.isclosed():
+            self.pool.release(key, conn)
+        else:
+            conn.close()
+        return found
+
+    def _match_stream(self, resp):
+        '''
+        Match the lines of a (tail) response as they're read.
+        '''
+        found = None
+        read = 0
+        rest = b''
+        while read < self.tail_bytes:
+            chunk = resp.read(min(CHUNK, self.tail_bytes - read))
+            if not chunk:
+                break
+            read += len(chunk)
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            found = self._match(lines)
+            if found is not None:
+                break
+        if found is None and rest:
+            found = self._match([rest])
+        return found, read
+
+    def _match_tail(self, resp):
+        '''
+        A server ignoring the Range header sends the whole log: it's
+        read till the end, keeping only the chunks of its last
+        tail_bytes, and those are matched.
+        '''
+        chunks = deque()
+        kept = 0
+        read = 0
+        while True:
+            chunk = resp.read(CHUNK)
+            if not chunk:
+                break
+            read += len(chunk)
+            chunks.append(chunk)
+            kept += len(chunk)
+            while kept - len(chunks[0]) >= self.tail_bytes:
+                kept -= len(chunks.popleft())
+        tail = b''.join(chunks)
+        lines = tail[-self.tail_bytes:].split(b'\n')
+        if read > self.tail_bytes:
+            # the first line is cut
+            lines.pop(0)
+        return self._match(lines), read
+
+    def _match(self, lines):
+        for line in lines:
+            line = line.decode('utf-8', 'replace').strip()
+            if self.signatures.search(line):
+                return line
+        return None
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._counters)
+            s['cached'] = len(self._cache)
+        return s
+
+
+_triage = None
+_triage_lock = threading.Lock()
+
+
+def get_triage(conf):
+    '''
+    Return the process wide triage, built according to the 'triage'
+    section of the gerrit config.
+    '''
+    global _triage
+    with _triage_lock:
+        if _triage is None:
+            opts = conf.get('triage', {})
+            _triage = Triage(log_path=opts.get('log_path', LOG_PATH),
+                             tail_bytes=int(opts.get('tail_bytes', TAIL_BYTES)),
+                             workers=int(opts.get('workers', WORKERS)),
+                             timeout=opts.get('timeout', TIMEOUT),
+                             signatures=opts.get('signatures', SIGNATURES),
+                             rewrite=opts.get('rewrite', None),
+                             cache_size=int(opts.get('cache_size', CACHE_SIZE)))
+        return _triage
+
+
+def reconfigure(old, new):
+    '''
+    Apply a reloaded gerrit config: the triage is built again on the
+    next use if its settings changed (the fetches in progress end on
+    the old one).
+    '''
+    global _triage
+    if old.get('triage', {}) == new.get('triage', {}):
+        return
+    with _triage_lock:
+        triage, _triage = _triage, None
+    if triage is not None:
+        triage._executor.shutdown(wait=False)
+        triage.pool.close()
+        log.info("Log triage dropped, the next one uses the new settings")
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+
+# Default size based rotation of the log file
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+# Attributes of a LogRecord that are not extra fields
+_RESERVED = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | \
+    frozenset(('message', 'asctime'))
+
+_listener = None
+_lock = threading.Lock()
+
+
+class JSONFormatter(logging.Formatter):
+    '''
+    One JSON object per line, with the extra fields of the record
+    (e.g. log.info("...", extra={'change': 778915})) as keys.
+    '''
+
+    def format(self, record):
+        out = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for k, v in record.__dict__.items():
+            if k not in _RESERVED and not k.startswith('_'):
+                out[k] = v
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            out['exc'] = record.exc_text
+        return json.dumps(out, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Let through only one out of `rate` debug records of the given
+    loggers (and their children), counted per message template.
+    '''
+
+    def __init__(self, rates):
+        super(SamplingFilter, self).__init__()
+        self.rates = dict(rates)
+        self._seen = {}
+
+    def _rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return 1
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self._rate(record.name)
+        if rate <= 1:
+            return True
+        key = (record.name, record.msg)
+        n = self._seen.get(key, 0)
+        self._seen[key] = n + 1
+        return n % rate == 0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''
+    The message and the traceback are rendered in the caller thread,
+    while the arguments and the frames they reference are alive, and
+    dropped from the queued copy; the extra fields are kept for the
+    JSON formatter. The rest of the formatting (and the disk write)
+    is paid by the listener thread.
+    '''
+
+    _formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup(conf, path=None):
+    '''
+    Route all the records through a queue to a (rotated) log file
+    written by a background thread, according to the 'logging'
+    section of the irc config. It can be called more than once,
+    only the first call counts.
+    '''
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return _listener
+
+        path = conf.get('path', path)
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=conf.get('max_bytes', MAX_BYTES),
+            backupCount=conf.get('backup_count', BACKUP_COUNT))
+        if conf.get('format', 'json') == 'json':
+            handler.setFormatter(JSONFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+        # not needed, and not free to collect for each record
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+
+        q = queue.SimpleQueue()
+        qh = _QueueHandler(q)
+        # sampled out records don't even reach the queue
+        if conf.get('sample', None):
+            qh.addFilter(SamplingFilter(conf['sample']))
+
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        root.addHandler(qh)
+        root.setLevel(conf.get('level', 'INFO'))
+        for name, level in conf.get('levels', {}).items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = logging.handlers.QueueListener(q, handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+        logging.getLogger(__name__).info("Logging to %s", path)
+        return _listener
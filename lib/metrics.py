@@ -0,0 +1,197 @@
+#!/usr/bin/python
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+SPAN = 'cephbot_span_seconds'
+
+log = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @classmethod
+    def merge(cls, histograms):
+        h = cls()
+        for other in histograms:
+            h.counts = [a + b for a, b in zip(h.counts, other.counts)]
+            h.sum += other.sum
+            h.count += other.count
+        return h
+
+    def quantile(self, q):
+        '''
+        Estimate a quantile as the upper bound of the bucket
+        holding it.
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra is not None else [])
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in items)
+
+
+class Metrics(object):
+    '''
+    In memory counters and latency histograms, cheap enough to be
+    updated on the hot path, rendered in the Prometheus text format.
+    '''
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            h = self._histograms.get(key, None)
+            if h is None:
+                h = self._histograms[key] = Histogram()
+            h.observe(value)
+
+    @contextmanager
+    def span(self, stage, **labels):
+        '''
+        Time the enclosed block as a stage of the hot path.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(SPAN, time.perf_counter() - start, stage=stage, **labels)
+
+    def add_collector(self, fn):
+        '''
+        fn returns a {name: value} dict of gauges, evaluated when
+        the metrics are rendered.
+        '''
+        self._collectors.append(fn)
+
+    def histogram(self, name, **labels):
+        with self._lock:
+            return self._histograms.get((name, _labels(labels)), None)
+
+    def histograms(self, name):
+        '''
+        The histograms of a metric as (labels dict, histogram) pairs.
+        '''
+        with self._lock:
+            return [(dict(labels), h) for (n, labels), h in self._histograms.items()
+                    if n == name]
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, _labels(labels)), 0)
+
+    def gauges(self):
+        values = {}
+        for fn in self._collectors:
+            try:
+                values.update(fn())
+            except Exception as e:
+                log.debug("Metrics collector failed: %s", e)
+        return values
+
+    def render(self):
+        '''
+        Render all the metrics in the Prometheus text format.
+        '''
+        out = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(h.counts), h.sum, h.count))
+                                for k, h in self._histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                out.append('# TYPE %s counter' % name)
+                typed.add(name)
+            out.append('%s%s %s' % (name, _format_labels(labels), value))
+
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                out.append('# TYPE %s histogram' % name)
+                typed.add(name)
+            cumulative = 0
+            for i, n in enumerate(counts):
+                cumulative += n
+                le = repr(float(BUCKETS[i])) if i < len(BUCKETS) else '+Inf'
+                out.append('%s_bucket%s %d' % (name, _format_labels(labels, ('le', le)), cumulative))
+            out.append('%s_sum%s %f' % (name, _format_labels(labels), total))
+            out.append('%s_count%s %d' % (name, _format_labels(labels), count))
+
+        for name, value in sorted(self.gauges().items()):
+            out.append('# TYPE %s gauge' % name)
+            out.append('%s %s' % (name, value))
+        return '\n'.join(out) + '\n'
+
+    def write_textfile(self, path):
+        '''
+        Atomically (re)write the metrics file read by the
+        node_exporter textfile collector.
+        '''
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def span(stage, **labels):
+    return _metrics.span(stage, **labels)
+
+
+def inc(name, value=1, **labels):
+    _metrics.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    _metrics.observe(name, value, **labels)
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+import json
+
+
+class Approval(object):
+    '''
+    A vote on a patchset (e.g. Zuul: Verified -1), granted is
+    when it was cast (0 if unknown).
+    '''
+    __slots__ = ('by', 'type', 'value', 'granted')
+
+    def __init__(self, by, type, value, granted=0):
+        self.by = by
+        self.type = type
+        self.value = value
+        self.granted = granted
+
+    @classmethod
+    def from_json(cls, a):
+        return cls(a.get('by', {}).get('name', ''), a.get('type', ''), int(a.get('value', 0)),
+                   int(a.get('grantedOn', 0)))
+
+    def __repr__(self):
+        return 'Approval({}, {}, {})'.format(self.by, self.type, self.value)
+
+
+class PatchSet(object):
+    '''
+    approvals is None while the patchset has no votes at all,
+    which usually means CI is still running.
+    '''
+    __slots__ = ('number', 'kind', 'revision', 'approvals')
+
+    def __init__(self, number, kind, revision, approvals=None):
+        self.number = number
+        self.kind = kind
+        self.revision = revision
+        self.approvals = approvals
+
+    @classmethod
+    def from_json(cls, p):
+        approvals = p.get('approvals', None)
+        if approvals is not None:
+            approvals = [Approval.from_json(a) for a in approvals]
+        return cls(int(p.get('number', 0)), p.get('kind', ''), p.get('revision', ''), approvals)
+
+    def __repr__(self):
+        return 'PatchSet({}, {})'.format(self.number, self.kind)
+
+
+class CIComment(object):
+    '''
+    A comment left by one of the allowed CI(s); patchset and
+    jobs (job name -> JobResult) are filled when the comment is
+    parsed.
+    '''
+    __slots__ = ('timestamp', 'reviewer', 'message', 'patchset', 'jobs')
+
+    def __init__(self, timestamp, reviewer, message, patchset=None, jobs=None):
+        self.timestamp = timestamp
+        self.reviewer = reviewer
+        self.message = message
+        self.patchset = patchset
+        self.jobs = jobs
+
+    @classmethod
+    def from_json(cls, c):
+        return cls(c.get('timestamp', 0), c.get('reviewer', {}).get('name', ''), c.get('message', ''))
+
+    @property
+    def key(self):
+        return (self.timestamp, self.reviewer)
+
+    def __repr__(self):
+        return 'CIComment({}, {})'.format(self.timestamp, self.reviewer)
+
+
+class ChangeRecord(object):
+    '''
+    The relevant part of a gerrit query result row, built
+    once and shared by the cache and the callbacks.
+    '''
+    __slots__ = ('number', 'project', 'branch', 'subject', 'url', 'status',
+                 'last_updated', 'current_patch_set', 'comments')
+
+    def __init__(self, number, project, branch, subject, url, status,
+                 last_updated, current_patch_set, comments):
+        self.number = number
+        self.project = project
+        self.branch = branch
+        self.subject = subject
+        self.url = url
+        self.status = status
+        self.last_updated = last_updated
+        self.current_patch_set = current_patch_set
+        self.comments = comments
+
+    @classmethod
+    def from_json(cls, row, allowed_ci=None):
+        '''
+        Build the record from a decoded (or raw) row: only the
+        comments of the allowed CI(s) are kept, if provided.
+        '''
+        if isinstance(row, str):
+            row = json.loads(row)
+        comments = [CIComment.from_json(c) for c in row.get('comments', [])
+                    if allowed_ci is None or c.get('reviewer', {}).get('name') in allowed_ci]
+        return cls(int(row['number']),
+                   row.get('project', ''),
+                   row.get('branch', ''),
+                   row.get('subject', ''),
+                   row.get('url', ''),
+                   row.get('status', ''),
+                   row.get('lastUpdated', 0),
+                   PatchSet.from_json(row.get('currentPatchSet', {})),
+                   comments)
+
+    def __repr__(self):
+        return 'ChangeRecord({}, {})'.format(self.number, self.current_patch_set)
@@ -1,21 +1,40 @@
 #!/usr/bin/python
 
-from prettytable import PrettyTable
-import paramiko
-import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import config
-import keyring
 import logging
 from datetime import datetime
 import os
-import re
+import threading
+import time
+
+from lib import change_cache
+from lib import ci_parser
+from lib import gerrit_rest
+from lib import gerrit_ssh
+from lib import job_history
+from lib import metrics
+from lib import query_decoder
+from lib import recorder
+from lib import single_flight
+from lib import snapshot_store
+from lib.model import ChangeRecord
 
 
 GERRIT_BASE_CMD = "gerrit"
+
+# A batch query is split when it exceeds one of these limits, to stay
+# far from the gerrit query limit and from the max command line length
+QUERY_CHUNK_SIZE = 50
+QUERY_MAX_LEN = 2048
 LOG_PATH = "/tmp/gerrit_cmds.log"
 
-# logging should be moved into the wrapping class
-logging.basicConfig(filename=LOG_PATH, level=logging.DEBUG)
+# Default fan-out settings (see the 'fanout' section of the gerrit
+# config): how many changes are loaded at the same time, and how long
+# (in seconds) a single change is waited for
+FANOUT_WORKERS = 8
+FANOUT_TIMEOUT = 20
+
 log = logging.getLogger(__name__)
 
 def gerrit_cmd(mode,
@@ -35,6 +54,8 @@ def gerrit_cmd(mode,
         if args is not None:
             for arg in args:
                 cmd += " --{}".format(arg)
+        if isinstance(ps, (list, tuple)):
+            ps = ' OR '.join('change:{}'.format(x) for x in ps)
         cmd += " --current-patch-set {} --format={}".format(ps, format)
 
     elif mode == "review":
@@ -73,26 +94,27 @@ def run_gerrit_cmd(gerrit_conf,
     loading the config from  a dict
     '''
 
-    key = paramiko.RSAKey(filename=(os.path.expanduser(gerrit_conf['user']['key'])))
+    if gerrit_conf.get('mode', 'ssh') == 'http':
+        if mode != 'review':
+            raise Exception("No valid options provided")
+        kwargs = dict((k, v) for k, v in kwargs.items()
+                      if isinstance(v, int) or allowed(v, args))
+        with metrics.span('gerrit_cmd', mode=mode):
+            return gerrit_rest.get_client(gerrit_conf).review(review, num, args, **kwargs)
 
     # generate the gerrit command to run against the defined PS
     cmd = gerrit_cmd(mode, review, num, args, **kwargs)
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.load_system_host_keys()
-
-    ssh.connect(hostname=gerrit_conf['instance'],
-                username=gerrit_conf['user']['name'],
-                port=gerrit_conf['port'],
-                pkey=key,
-                allow_agent=True)
 
-    stdin, stdout, stderr = ssh.exec_command(cmd)
-
-    payload = stdout.readlines()
-    perr = stderr.readlines()
-
-    ssh.close()
+    # the command runs on a new channel opened on a pooled
+    # (and already authenticated) transport
+    started = time.monotonic()
+    with metrics.span('gerrit_cmd', mode=mode):
+        payload, perr = gerrit_ssh.get_pool(gerrit_conf).exec_command(gerrit_conf, cmd)
+    rec = recorder.get_recorder()
+    if rec is not None:
+        out = ''.join(payload)
+        rec.gerrit(cmd, time.monotonic() - started,
+                   out if len(out) <= rec.max_body else None, ''.join(perr))
 
     if len(perr) > 0:
         return perr
@@ -100,9 +122,412 @@ def run_gerrit_cmd(gerrit_conf,
     return payload
 
 
+def stream_gerrit_cmd(gerrit_conf,
+                      mode,
+                      review,
+                      num=None,
+                      args=None,
+                      **kwargs):
+    '''
+    Same as run_gerrit_cmd, but the output is yielded in chunks
+    while it's read from the channel.
+    '''
+    cmd = gerrit_cmd(mode, review, num, args, **kwargs)
+    out = gerrit_ssh.get_pool(gerrit_conf).stream_command(gerrit_conf, cmd)
+    rec = recorder.get_recorder()
+    if rec is not None:
+        return _recorded(rec, cmd, out)
+    return out
+
+
+def _recorded(rec, cmd, chunks):
+    '''
+    Pass the chunks through, and record the whole output (or the
+    error, as gerrit wrote it) once it's over; the output is not
+    kept past max_body.
+    '''
+    started = time.monotonic()
+    out = []
+    size = 0
+    try:
+        for chunk in chunks:
+            if out is not None:
+                size += len(chunk)
+                if size > rec.max_body:
+                    out = None
+                else:
+                    out.append(chunk)
+            yield chunk
+    except Exception as e:
+        rec.gerrit(cmd, time.monotonic() - started, ''.join(out) if out is not None else None,
+                   getattr(e, 'stderr', str(e)))
+        raise
+    rec.gerrit(cmd, time.monotonic() - started, ''.join(out) if out is not None else None, '')
+
+
+def _chunks(reviews):
+    '''
+    Group the reviews so that each query stays within both
+    QUERY_CHUNK_SIZE changes and QUERY_MAX_LEN chars.
+    '''
+    chunk = []
+    size = 0
+    for r in reviews:
+        term = len('change:{} OR '.format(r))
+        if chunk and (len(chunk) >= QUERY_CHUNK_SIZE or size + term > QUERY_MAX_LEN):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(r)
+        size += term
+    if chunk:
+        yield chunk
+
+
+def _parse_rows(decoded):
+    '''
+    Go through the decoded rows of a gerrit query: each row is a
+    change, and the last one contains the stats.
+    '''
+    rows = []
+    try:
+        decoded = list(decoded)
+    except ValueError as e:
+        raise Exception("Unexpected gerrit output: %s" % e)
+    for row in decoded:
+        if row.get('type') == 'stats':
+            log.debug("Query stats: %s", row)
+            if row.get('moreChanges', False):
+                log.warning("Gerrit truncated the result of a batch query")
+        elif row.get('type') == 'error':
+            raise Exception("Gerrit query failed: %s" % row.get('message', ''))
+        else:
+            rows.append(row)
+    return rows
+
+
+def query_changes(conf, reviews, args=None, keep=None):
+    '''
+    Query all the given reviews using a single gerrit
+    query per chunk (change:A OR change:B ...) and return a
+    dict mapping each change number to its ChangeRecord.
+    keep is how many CI comments are kept (default: ci_history).
+    '''
+    records = {}
+    flight = single_flight.get_flight()
+    for chunk in _chunks([str(r) for r in reviews]):
+        # the same query already in flight is waited for, not re-run
+        key = ('query', tuple(chunk), tuple(args or ()), keep)
+        records.update(flight.do(key, _query_chunk, conf, chunk, args, keep))
+    return records
+
+
+def _query_chunk(conf, chunk, args, keep=None):
+    allowed_ci = conf.get('allowed_ci', None)
+    if keep is None:
+        keep = conf.get('ci_history', query_decoder.DEFAULT_CI_HISTORY)
+    if conf.get('mode', 'ssh') == 'http':
+        with metrics.span('gerrit_cmd', mode='query'):
+            rows = gerrit_rest.get_client(conf).query(chunk, args, allowed_ci, keep)
+        return dict((str(row['number']), ChangeRecord.from_json(row, allowed_ci)) for row in rows)
+
+    # the output is decoded while it's read: the comments of
+    # the non allowed reviewers are dropped on the fly
+    decoder = query_decoder.QueryDecoder(allowed_ci, keep)
+    with metrics.span('gerrit_cmd', mode='query'):
+        out = stream_gerrit_cmd(conf, 'query', chunk, None, args)
+        rows = _parse_rows(decoder.decode(out))
+    return dict((str(row['number']), ChangeRecord.from_json(row, allowed_ci)) for row in rows)
+
+
 def load_latest_available_data(conf, review):
-    data = run_gerrit_cmd(config.gerrit_config, 'query', review, None, ['comments'])
-    return data[0]
+    '''
+    Return the record of the given review, serving it from the
+    cache when possible: an expired entry is revalidated with a
+    query that doesn't carry the (large) comment history.
+    Concurrent loads of the same review share a single fetch.
+    '''
+    record = change_cache.get_cache(conf).get(review)
+    if record is not None:
+        return record
+    return single_flight.get_flight().do(('load', str(review)),
+                                         _load_latest_available_data, conf, review)
+
+
+def _load_latest_available_data(conf, review):
+    cache = change_cache.get_cache(conf)
+    # it could have been loaded by a flight that just landed
+    record = cache.get(review)
+    if record is not None:
+        return record
+
+    store = snapshot_store.get_store(conf)
+    if store is not None and cache.peek(review) is None:
+        # warm start: what we knew before a restart just needs to
+        # be revalidated
+        stored = store.latest(review)
+        if stored is not None:
+            cache.put(review, stored, stale=True)
+
+    if cache.revalidate and cache.peek(review) is not None:
+        current = query_changes(conf, [review]).get(str(review), None)
+        if current is not None and cache.is_current(review, current.last_updated):
+            log.debug("Change %s not updated, serving it from the cache", review)
+            return cache.peek(review)
+
+    record = query_changes(conf, [review], ['comments']).get(str(review), None)
+    if record is not None:
+        _remember(conf, review, record)
+    return record
+
+
+def _remember(conf, review, record):
+    change_cache.get_cache(conf).put(review, record)
+    store = snapshot_store.get_store(conf)
+    if store is not None:
+        store.put(record)
+
+
+def resolve_group(conf, name):
+    '''
+    Return the changes of a group: 'all' is every watched
+    submission, the others are defined in conf['groups'].
+    None if there's no such group.
+    '''
+    if name == 'all':
+        return [str(r) for r, opts in conf.get('submissions', {}).items()
+                if 'watch' in opts.get('actions', [])]
+    group = conf.get('groups', {}).get(name, None)
+    return [str(r) for r in group] if group is not None else None
+
+
+_fanout = None
+_fanout_lock = threading.Lock()
+
+
+def _get_fanout(conf):
+    global _fanout
+    with _fanout_lock:
+        if _fanout is None:
+            _fanout = ThreadPoolExecutor(
+                max_workers=conf.get('fanout', {}).get('workers', FANOUT_WORKERS),
+                thread_name_prefix='cephbot-fanout')
+        return _fanout
+
+
+def reconfigure(old, new):
+    '''
+    Apply a reloaded gerrit config: the fan-out pool is built again
+    on the next use if its size changed (the loads in progress end
+    on the old one).
+    '''
+    global _fanout
+    if old.get('fanout', {}).get('workers') == new.get('fanout', {}).get('workers'):
+        return
+    with _fanout_lock:
+        fanout, _fanout = _fanout, None
+    if fanout is not None:
+        fanout.shutdown(wait=False)
+        log.info("Fan-out pool dropped, the next one uses the new size")
+
+
+def load_many(conf, reviews, timeout=None):
+    '''
+    Load several reviews in parallel (at most fanout.workers
+    queries at a time), serving the fresh ones from the cache. Return a dict mapping each
+    review to its record (None if not found), and the list of the
+    reviews not loaded within the timeout.
+    '''
+    if timeout is None:
+        timeout = conf.get('fanout', {}).get('timeout', FANOUT_TIMEOUT)
+    reviews = [str(r) for r in reviews]
+    records = {}
+    cache = change_cache.get_cache(conf)
+    missing = []
+    for r in reviews:
+        # fresh records don't need a round trip
+        record = cache.get(r)
+        if record is not None:
+            records[r] = record
+        else:
+            missing.append(r)
+
+    # each review is loaded on its own, with its own deadline
+    # (counted from when a worker picks it up): a slow one doesn't
+    # take the others down with it
+    pool = _get_fanout(conf)
+    started = {}
+    futures = dict((pool.submit(_load_one, conf, r, started), r) for r in missing)
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        deadlines = [started[futures[f]] + timeout for f in pending if futures[f] in started]
+        done, pending = wait(pending, max(0, min(deadlines) - now) if deadlines else timeout,
+                             return_when=FIRST_COMPLETED)
+        for f in done:
+            r = futures[f]
+            try:
+                records[r] = f.result()
+            except Exception as e:
+                log.warning("Unable to load %s: %s", r, e)
+                records[r] = None
+        now = time.monotonic()
+        late = set(f for f in pending if futures[f] in started and
+                   now >= started[futures[f]] + timeout)
+        if not done and not late and not deadlines:
+            # nothing even started within the timeout
+            late = set(pending)
+        for f in late:
+            f.cancel()
+        pending -= late
+    timedout = [r for r in reviews if r not in records]
+    return records, timedout
+
+
+def _load_one(conf, review, started):
+    started[review] = time.monotonic()
+    record = query_changes(conf, [review], ['comments']).get(review, None)
+    if record is not None:
+        _remember(conf, review, record)
+    return record
+
+
+def _current_jobs(conf, d):
+    '''
+    The jobs of the current patchset, according to the latest
+    comment of each allowed CI on it (each CI has its own jobs).
+    '''
+    process_data(conf, d)
+    allowed = conf['allowed_ci']
+    psnum = d.current_patch_set.number
+    jobs = {}
+    seen = set()
+    for c in reversed(d.comments):
+        if c.reviewer in allowed and c.reviewer not in seen and \
+                c.patchset == psnum and c.jobs is not None:
+            seen.add(c.reviewer)
+            for name, job in c.jobs.items():
+                jobs.setdefault(name, job)
+    return jobs
+
+
+def _show_group(conf, mode, records, timedout):
+    '''
+    One compact line per change, in a single reply.
+    '''
+    lines = []
+    for review in sorted(records, key=int):
+        d = records[review]
+        if d is None:
+            lines.append('{}: not found'.format(review))
+            continue
+        ps = d.current_patch_set
+        if mode == 'summary':
+            lines.append('{} {} PS {} ({}) {}'.format(review, d.project, ps.number, ps.kind, d.status))
+        elif mode == 'diff':
+            lines.append('{}: {}'.format(review, _show_diff(conf, review)))
+        elif mode == 'status':
+            if ps.approvals is None:
+                votes = 'CI running'
+            else:
+                votes = ', '.join('{} {:+d}'.format(a.by, a.value) for a in ps.approvals) or '-'
+            lines.append('{} PS {}: {}'.format(review, ps.number, votes))
+        else:
+            jobs = _current_jobs(conf, d)
+            failed = [name for name, job in jobs.items() if job.failed]
+            lines.append('{} PS {}: {} jobs, {} failed{}'.format(
+                review, ps.number, len(jobs), len(failed),
+                ' ({})'.format(', '.join(failed)) if failed else ''))
+    if timedout:
+        lines.append('timed out: {}'.format(', '.join(sorted(timedout, key=int))))
+    return '\n'.join(lines)
+
+
+def _show_diff(conf, review, refresh=False):
+    '''
+    What changed between the last two known versions of the
+    review, according to the snapshot store. With refresh, the
+    current version is stored first (None if there's no such
+    review).
+    '''
+    store = snapshot_store.get_store(conf)
+    if store is None:
+        return "the snapshot store is not enabled"
+    if refresh and not _refresh_snapshot(conf, store, review):
+        return None
+    snapshots = store.snapshots(review, 2)
+    if len(snapshots) < 2:
+        return "nothing to compare yet"
+    new, old = snapshots
+    changes = snapshot_store.diff(old, new)
+    since = datetime.fromtimestamp(old.taken).strftime('%Y-%m-%d %H:%M')
+    if not changes:
+        return "nothing changed since {}".format(since)
+    return "since {}: {}".format(since, '; '.join(changes))
+
+
+def _refresh_snapshot(conf, store, review):
+    '''
+    Make sure the store has the current version of the review: a
+    query without the comments tells if the stored one is still
+    current, the full record is only loaded when it's not. Return
+    False if the review doesn't exist.
+    '''
+    known = store.last_updated(review)
+    if known is not None:
+        current = query_changes(conf, [review]).get(str(review), None)
+        if current is None:
+            return False
+        if current.last_updated == known:
+            log.debug("Change %s not updated since its last snapshot", review)
+            return True
+    record = query_changes(conf, [review], ['comments']).get(str(review), None)
+    if record is None:
+        return False
+    _remember(conf, review, record)
+    return True
+
+
+def load_history(conf, reviews):
+    '''
+    Load the given reviews with the CI comments of the whole flaky
+    window: the cached records only have the last ci_history ones.
+    Return a dict mapping each review to its record (None if not
+    found). The records are not cached.
+    '''
+    window = int(conf.get('flaky', {}).get('window', job_history.WINDOW))
+    keep = max(window, conf.get('ci_history', query_decoder.DEFAULT_CI_HISTORY))
+    reviews = [str(r) for r in reviews]
+    records = query_changes(conf, reviews, ['comments'], keep)
+    return dict((r, records.get(r, None)) for r in reviews)
+
+
+def _show_flaky(conf, records):
+    '''
+    The jobs failing most often (or flipping on the same patchset)
+    on the given changes (see load_history).
+    '''
+    changes = []
+    for review, d in records.items():
+        if d is not None:
+            # the new CI comments are added to the history on the way
+            process_data(conf, d)
+            changes.append(review)
+    top = job_history.get_history(conf).top(
+        changes, conf.get('flaky', {}).get('top', job_history.TOP))
+    lines = []
+    for s in top:
+        line = '- {}: {}/{} failed ({:.0%})'.format(s.name, s.failures, s.runs, s.failure_rate)
+        if s.rechecks:
+            line += ', {} recheck(s)'.format(s.rechecks)
+        if s.flips:
+            line += ', flipped on {} PS'.format(s.flips)
+        if s.duration is not None:
+            line += ', {}m avg'.format(int(round(s.duration / 60)))
+            if s.trend is not None and abs(s.trend) >= 60:
+                line += ' ({:+d}m lately)'.format(int(round(s.trend / 60)))
+        lines.append(line)
+    return '\n'.join(lines)
 
 
 def _show_summary(data, raw=True):
@@ -110,64 +535,112 @@ def _show_summary(data, raw=True):
     Print a summary related to the last execution
     of the current patch
     '''
-    s = json.loads(data)
+    ps = data.current_patch_set
     if not raw:
+        from prettytable import PrettyTable
         summary = PrettyTable(["Project", "Current PS", "Last Action"])
-        summary.add_row([s['project'], s['currentPatchSet']['number'], s['currentPatchSet']['kind']])
+        summary.add_row([data.project, ps.number, ps.kind])
 
         status = PrettyTable(["Name", "Status"])
-        if s['currentPatchSet'].get('approvals', None) is None:  # CI is currently running!
+        if ps.approvals is None:  # CI is currently running!
             print("STATUS: The patch is currently running on CI")
         else:
-            for approval in s['currentPatchSet']['approvals']:
-                status.add_row([approval['by']['name'], approval['value']])
+            for approval in ps.approvals:
+                status.add_row([approval.by, approval.value])
         return (summary, status)
     else:
-        summary = 'Project: {} \nCurrent PatchSet: {} \nLast action: {}'.format(s['project'], \
-                    s['currentPatchSet']['number'], s['currentPatchSet']['kind'])
+        summary = 'Project: {} \nCurrent PatchSet: {} \nLast action: {}'.format(data.project, \
+                    ps.number, ps.kind)
         status = []
-        if s['currentPatchSet'].get('approvals', None) is None:  # CI is currently running!
+        if ps.approvals is None:  # CI is currently running!
             status.append("STATUS: The patch is currently running on CI")
         else:
-            for approval in s['currentPatchSet']['approvals']:
-                status.append('{}: {}\n'.format(approval['by']['name'], approval['value']))
+            for approval in ps.approvals:
+                status.append('{}: {}\n'.format(approval.by, approval.value))
         return (summary, ''.join(status))
 
 
 def _unpack(log):
     s = ""
-    for name, link in log.items():
-        s += '- {} {}\n'.format(name, link)
+    for name, job in log.items():
+        s += '- {} {}\n'.format(name, job)
+    return s
+
+
+def _url_prefix(urls):
+    '''
+    The longest common prefix (up to a '/') of the given urls.
+    '''
+    if len(urls) < 2:
+        return ''
+    prefix = os.path.commonprefix(urls)
+    return prefix[:prefix.rfind('/') + 1]
+
+
+def _unpack_compact(jobs):
+    '''
+    The jobs with the urls shortened: their common prefix is
+    printed once, on top.
+    '''
+    prefix = _url_prefix([j.url for j in jobs])
+    s = '({}...)\n'.format(prefix) if prefix else ''
+    for job in jobs:
+        s += '- {} {} {}\n'.format(job.name, job.result or '', job.url[len(prefix):])
     return s
 
 
 def _show_ci_logs(retrieved_data, raw=True):
     if not raw:
+        from prettytable import PrettyTable
         summary = PrettyTable(["Date/Time", "Reviewer", "Logs"])
-        for elem in retrieved_data:
-            log.debug("TIME: %s \nREVIEWER: %s\n" % (list(elem.keys())[0][0], list(elem.keys())[0][1]))
-            s = ""
-            for k, lg in elem.items():
-                s = _unpack(lg)
+        for c in retrieved_data:
+            log.debug("TIME: %s \nREVIEWER: %s\n", c.timestamp, c.reviewer)
+            s = _unpack(c.jobs)
             log.debug(s)
-            summary.add_row([datetime.fromtimestamp(list(elem.keys())[0][0]), list(elem.keys())[0][1], s])
+            summary.add_row([datetime.fromtimestamp(c.timestamp), c.reviewer, s])
         return summary
     else:
+        # the failed jobs of every CI comment come first, so they
+        # land on the first page of the reply, then the others
+        failed = []
+        others = []
+        for c in retrieved_data:
+            log.debug("(%s - %s\n)", c.timestamp, c.reviewer)
+            jobs = list(c.jobs.values())
+            failed.append((c.reviewer, [j for j in jobs if j.failed]))
+            others.append((c.reviewer, [j for j in jobs if not j.failed]))
         ls = []
-        # for each tuple (time, reviewer) get the relevant logs
-        for elem in retrieved_data:
-            # The tuple (time, reviewer) is the new key
-            log.debug("(%s - %s\n)" % (list(elem.keys())[0][0], list(elem.keys())[0][1]))
-            s = ""
-            #cur_header = (list(elem.keys())[0][0], list(elem.keys())[0][1])
-            ls.append('{}\n'.format(list(elem.keys())[0][1]))
-            for k, lg in elem.items():
-                s = _unpack(lg)
-                ls.append(s)
-            #ls[cur_header] = s
+        for reviewer, jobs in failed + others:
+            if jobs:
+                ls.append('{}\n'.format(reviewer))
+                ls.append(_unpack_compact(jobs))
         return(''.join(ls))
 
 
+def _show_triage(conf, retrieved_data):
+    '''
+    The first error line found in the log of each failed job.
+    '''
+    from lib import log_triage
+    failed = [j for c in retrieved_data for j in c.jobs.values() if j.failed]
+    if not failed:
+        return ''
+    with metrics.span('triage'):
+        found = log_triage.get_triage(conf).triage(failed)
+    ls = []
+    for c in retrieved_data:
+        jobs = [j for j in c.jobs.values() if j.failed]
+        if not jobs:
+            continue
+        ls.append('{}\n'.format(c.reviewer))
+        for j in jobs:
+            line = found.get(j.name, None)
+            if line is None:
+                line = 'no known error found (or the log is not available)'
+            ls.append('- {} {}: {}\n'.format(j.name, j.result, line))
+    return ''.join(ls)
+
+
 
 def _rebase(conf, review, psnum, args, **kwargs):
 
@@ -178,6 +651,9 @@ def _rebase(conf, review, psnum, args, **kwargs):
                          psnum,
                          args,
                          **kwargs)
+    # the change is going to be updated, drop what we know about it
+    change_cache.get_cache(conf).invalidate(review)
+
     if len(out) == 0:
         '''
         rebase succeeded, an empty array is
@@ -185,7 +661,7 @@ def _rebase(conf, review, psnum, args, **kwargs):
         '''
         return True
 
-    print(out)
+    log.debug("Rebase of %s PS %s: %s", review, psnum, out)
     if "fatal" in out[0]:  # Cannot rebase, just recheck for now
         return False
     return True
@@ -199,79 +675,59 @@ def _recheck(conf, review, psnum, args=None, **kwargs):
                    review,
                    psnum,
                    **kwargs)
+    change_cache.get_cache(conf).invalidate(review)
     return True
 
 
 def _show_ci_comment_list(comments):
-    for k in list(comments.keys()):
-        print('{}, {}'.format(k[0], k[1]))
-
-
-def _get_job(k, v, depth):
-    _jobs = {}
-    indent_level = 0  # just check the first level
-    line = re.compile(r'( *)- ([^\n]+)(?:: ([^\n]*))?\n?')
-    indent_level = 0  # just check the first level
-    for indent, job, other in line.findall(v[depth].strip()):
-        indent = len(indent)
-        if indent > indent_level:
-            raise Exception("unexpected indent")
-        k = job.split(" ")[0]
-        log.debug("TOKEN NAME DETECTED: %s\nTOKEN VALUE DETECTED %s" % (job.split(" ")[0], job.split(" ")[1]))
-        v = job.split(" ")[1]
-        _jobs[k] = v
-    return _jobs
-
-
-def _get_ci_logs(filtered, data, depth):
-    if len(filtered) == 0:
-        return []
-
-    k = list(filtered.keys())
-    v = list(filtered.values())
-
-    log.debug("%s, %s" % (k[-2]))
-    log.debug("%s, %s" % (k[-1], v[-1].strip()))
-
-    jobs = []
-    for index in reversed(range(depth, 0)):
-        j = _get_job(k, v, index)
-        jobs.append({k[int(index)]: j})
-    return jobs
+    for c in comments:
+        print('{}, {}'.format(c.timestamp, c.reviewer))
 
 
 def process_data(gerrit_conf, data):
-    s = json.loads(data)
-    allowed = gerrit_conf['allowed_ci']
-    latest_ps = s['currentPatchSet']['number']
-    filtered = {}
+    with metrics.span('process_data'):
+        return _process_data(gerrit_conf, data)
 
 
-    # let's filter according to the allowed CI(s)
-    for comment in s.get('comments', {}):
-        if comment['reviewer']['name'] in allowed:
-            filtered[(comment['timestamp'], comment['reviewer']['name'])] = comment['message']
+def _process_data(gerrit_conf, data):
+    allowed = gerrit_conf['allowed_ci']
+    latest_ps = data.current_patch_set.number
 
-            log.debug("%s, %s" % (comment['timestamp'], comment['reviewer']['name']))
+    # let's filter according to the allowed CI(s)
+    filtered = [c for c in data.comments if c.reviewer in allowed]
     # _show_ci_comment_list(filtered)
+
+    # only the comments never seen before are actually parsed
+    with metrics.span('ci_parse'):
+        ci_parser.get_parser().update(data.number, filtered)
+    job_history.get_history(gerrit_conf).add(data.number, filtered)
+
+    # latest comment first
     depth = -2
-    jb = _get_ci_logs(filtered, data, depth)
+    jb = list(reversed(filtered[depth:]))
 
-    log.debug(jb)  # log the resulting jobs
+    log.debug("Last CI comments of %s: %s", data.number, jb)
     return latest_ps, jb
 
 
 if __name__ == '__main__':
 
+    logging.basicConfig(filename=LOG_PATH, level=logging.DEBUG)
+
     reviews = config.gerrit_config['submissions']
     comments = []
     psnum = 0
 
     assert isinstance(reviews, dict)
 
+    # READING: a single round trip for all the submissions
+    records = query_changes(config.gerrit_config, list(reviews.keys()), ['comments'])
+
     for r in list(reviews.keys()):
-        # READING
-        d = load_latest_available_data(config.gerrit_config, r)
+        d = records.get(str(r), None)
+        if d is None:
+            print("Unable to find review %s" % r)
+            continue
         psnum, comments = process_data(config.gerrit_config, d)
         summary, status = _show_summary(d)
         logs = _show_ci_logs(comments)
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+from collections import deque
+import json
+import re
+import time
+
+from lib import metrics
+
+
+# Number of (allowed) CI comments kept for each change
+DEFAULT_CI_HISTORY = 10
+
+# the next char we care about, outside and inside a string
+_SPECIAL = re.compile(r'["{}\[\]]')
+_STRING = re.compile(r'["\\]')
+
+# the key of the row array streamed comment by comment
+_COMMENTS_KEY = '"comments"'
+
+
+class QueryDecoder(object):
+    '''
+    Incremental decoder of the gerrit query JSON output: data can
+    be fed as it's read from the channel, and completed rows are
+    returned as soon as they are available.
+
+    The comments array of a row is never kept as a whole: each
+    comment is decoded as soon as it's complete, dropped if the
+    reviewer is not an allowed CI, and only the last `keep` ones
+    survive, so the memory needed doesn't depend on how long the
+    history of the change is.
+    '''
+
+    def __init__(self, allowed_ci=None, keep=DEFAULT_CI_HISTORY):
+        self.allowed_ci = frozenset(allowed_ci) if allowed_ci is not None else None
+        self.keep = keep
+        self.dropped = 0
+
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._in_comments = False
+        self._new_row()
+
+    def _new_row(self):
+        self._row = []
+        self._elem = []
+        self._comments = deque(maxlen=self.keep)
+        self._streamed = False
+        # the last string of the row (with its quotes) and the last
+        # key completed by a ':', whatever the chunks boundaries are
+        self._string = None
+        self._last_string = None
+        self._key = None
+
+    def _target(self):
+        '''
+        Where the plain text goes: the current comment, the row or
+        nowhere (separators between comments and rows).
+        '''
+        if self._in_comments:
+            return self._elem if self._depth >= 3 else None
+        return self._row if self._depth > 0 else None
+
+    def _add(self, text):
+        target = self._target()
+        if target is not None and text:
+            target.append(text)
+            if self._string is not None:
+                self._string.append(text)
+
+    def _plain(self, text):
+        '''
+        Text outside strings: a ':' completes the key of a row field.
+        '''
+        self._add(text)
+        if self._depth == 1 and not self._in_comments and ':' in text:
+            self._key = self._last_string
+
+    def _comment_done(self):
+        comment = json.loads(''.join(self._elem))
+        self._elem = []
+        if self.allowed_ci is None or \
+                comment.get('reviewer', {}).get('name') in self.allowed_ci:
+            self._comments.append(comment)
+        else:
+            self.dropped += 1
+
+    def _row_done(self):
+        row = json.loads(''.join(self._row))
+        if self._streamed:
+            row['comments'] = list(self._comments)
+        self._new_row()
+        return row
+
+    def feed(self, data):
+        '''
+        Consume a chunk of text and return the rows it completed.
+        '''
+        rows = []
+        i = 0
+        n = len(data)
+        while i < n:
+            if self._escape:
+                self._add(data[i])
+                self._escape = False
+                i += 1
+                continue
+
+            if self._in_string:
+                m = _STRING.search(data, i)
+                if m is None:
+                    self._add(data[i:])
+                    break
+                j = m.end()
+                self._add(data[i:j])
+                if m.group() == '\\':
+                    self._escape = True
+                else:
+                    self._in_string = False
+                    if self._string is not None:
+                        self._last_string = ''.join(self._string)
+                        self._string = None
+                i = j
+                continue
+
+            m = _SPECIAL.search(data, i)
+            if m is None:
+                self._plain(data[i:])
+                break
+            self._plain(data[i:m.start()])
+            c = m.group()
+            i = m.end()
+
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and not self._in_comments:
+                    self._string = []
+                self._add(c)
+            elif c in '{[':
+                if c == '[' and self._depth == 1 and not self._in_comments and \
+                        self._key == _COMMENTS_KEY:
+                    self._row.append(c)
+                    self._in_comments = True
+                    self._streamed = True
+                    self._depth += 1
+                    continue
+                self._depth += 1
+                self._add(c)
+            else:
+                self._add(c)
+                self._depth -= 1
+                if self._in_comments and self._depth == 2:
+                    self._comment_done()
+                elif self._in_comments and self._depth == 1:
+                    self._in_comments = False
+                    self._row.append(c)
+                elif self._depth == 0:
+                    rows.append(self._row_done())
+                elif self._depth < 0:
+                    raise ValueError("Unbalanced gerrit output")
+        return rows
+
+    def decode(self, chunks):
+        '''
+        Yield the rows found in an iterable of text chunks.
+        '''
+        decoding = 0.0
+        for chunk in chunks:
+            start = time.perf_counter()
+            rows = self.feed(chunk)
+            decoding += time.perf_counter() - start
+            for row in rows:
+                yield row
+        metrics.observe(metrics.SPAN, decoding, stage='json_decode')
+        if self._depth != 0 or ''.join(self._row).strip():
+            raise ValueError("Truncated gerrit output")
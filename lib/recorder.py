@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+
+
+# Records are flushed to the file every FLUSH_EVERY of them
+FLUSH_EVERY = 64
+
+# Gerrit outputs longer than this (in chars) are not captured: only
+# the command and its timing are recorded
+MAX_BODY = 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+
+class Recorder(object):
+    '''
+    Write what the bot receives (irc messages) and what gerrit
+    answers to a log that bench/replay.py can feed back to the bot.
+    One JSON array per line, the time is relative to the start:
+
+        ["irc", t, type, source, target, text]
+        ["body", id, text]       (each gerrit output is stored once)
+        ["gerrit", t, cmd, seconds, stdout id, stderr id]
+
+    The stdout id is null when the output was longer than max_body.
+    The file is gzipped if its name ends with .gz. The records are
+    queued and written by a background thread, so the callers (e.g.
+    the reactor) never wait for the disk.
+    '''
+
+    def __init__(self, path, max_body=MAX_BODY, clock=time.monotonic):
+        self.path = path
+        self.max_body = max_body
+        self._clock = clock
+        self._start = clock()
+        opener = gzip.open if path.endswith('.gz') else open
+        self._file = opener(path, 'wt')
+        self._bodies = {}
+        self._count = 0
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._run, name='cephbot-recorder', daemon=True)
+        self._writer.start()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            if record[0] == 'gerrit':
+                kind, t, cmd, seconds, out, err = record
+                record = (kind, t, cmd, seconds,
+                          self._body(out) if out is not None else None, self._body(err))
+            self._write(*record)
+        self._file.close()
+
+    def _write(self, *record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._count += 1
+        if self._count % FLUSH_EVERY == 0:
+            self._file.flush()
+
+    def _body(self, text):
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        body = self._bodies.get(digest, None)
+        if body is None:
+            body = self._bodies[digest] = len(self._bodies)
+            self._write('body', body, text)
+        return body
+
+    def irc(self, e):
+        self._queue.put(('irc', round(self._clock() - self._start, 4),
+                         e.type, e.source, e.target, e.arguments[0] if e.arguments else ''))
+
+    def gerrit(self, cmd, seconds, out, err):
+        '''
+        :param seconds is how long cmd took (it just completed)
+        :param out and err are the (joined) output of cmd, out is
+            None if it was not captured
+        '''
+        started = self._clock() - seconds
+        self._queue.put(('gerrit', round(started - self._start, 4), cmd,
+                         round(seconds, 4), out, err))
+
+    def close(self):
+        '''
+        Write what's still queued and close the file.
+        '''
+        self._queue.put(None)
+        self._writer.join()
+
+
+def load(path):
+    '''
+    Return the irc records and the gerrit records (with their
+    output) of a recorded log.
+    '''
+    opener = gzip.open if path.endswith('.gz') else open
+    bodies = {}
+    irc = []
+    gerrit = []
+    with opener(path, 'rt') as f:
+        for line in f:
+            record = json.loads(line)
+            if record[0] == 'body':
+                bodies[record[1]] = record[2]
+            elif record[0] == 'irc':
+                irc.append(record[1:])
+            elif record[0] == 'gerrit':
+                t, cmd, seconds, out, err = record[1:]
+                gerrit.append((t, cmd, seconds, bodies[out] if out is not None else None,
+                               bodies[err]))
+    return irc, gerrit
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def setup(conf):
+    '''
+    Start recording according to the 'record' section of the irc
+    config (nothing is recorded without a path).
+    '''
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None and conf.get('path', None):
+            _recorder = Recorder(conf['path'], max_body=int(conf.get('max_body', MAX_BODY)))
+            atexit.register(_recorder.close)
+            log.info("Recording the traffic to %s", conf['path'])
+        return _recorder
+
+
+def get_recorder():
+    return _recorder
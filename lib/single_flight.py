@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Coalesce concurrent calls with the same key: the first caller
+    runs the function, the ones arriving while it's in flight wait
+    for it and share its result (or exception).
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._counters = {
+            'calls': 0,
+            'merged': 0,
+        }
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            self._counters['calls'] += 1
+            call = self._calls.get(key, None)
+            if call is not None:
+                self._counters['merged'] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            log.debug("Waiting for the in flight %s", key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            # the callers arriving from now on start a new call
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._counters)
+            s['in_flight'] = len(self._calls)
+        return s
+
+
+_flight = SingleFlight()
+
+
+def get_flight():
+    return _flight
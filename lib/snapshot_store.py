@@ -0,0 +1,343 @@
+#!/usr/bin/python
+
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+
+from lib import ci_parser
+from lib.model import Approval, ChangeRecord, CIComment, PatchSet
+
+
+# Pending snapshots are written in a single transaction when there are
+# BATCH_SIZE of them or the oldest one is FLUSH_INTERVAL seconds old
+# (a timer flushes them if nothing else is put meanwhile)
+BATCH_SIZE = 32
+FLUSH_INTERVAL = 5
+
+# Snapshots kept for each change
+KEEP = 10
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    change TEXT NOT NULL,
+    patchset INTEGER NOT NULL,
+    last_updated INTEGER NOT NULL,
+    taken REAL NOT NULL,
+    project TEXT, branch TEXT, subject TEXT, url TEXT, status TEXT,
+    kind TEXT, revision TEXT,
+    ci_running INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_change ON snapshots (change, patchset, id);
+CREATE TABLE IF NOT EXISTS approvals (
+    snapshot INTEGER NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+    by TEXT, type TEXT, value INTEGER
+);
+CREATE INDEX IF NOT EXISTS approvals_snapshot ON approvals (snapshot);
+CREATE TABLE IF NOT EXISTS jobs (
+    snapshot INTEGER NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+    name TEXT, url TEXT, result TEXT, duration INTEGER, voting INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_snapshot ON jobs (snapshot);
+CREATE TABLE IF NOT EXISTS comments (
+    change TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    reviewer TEXT NOT NULL,
+    message TEXT,
+    PRIMARY KEY (change, timestamp, reviewer)
+);
+'''
+
+log = logging.getLogger(__name__)
+
+
+class Snapshot(object):
+    '''
+    What was known about a change at a given time: its current
+    patchset, the votes and the CI job results of that patchset.
+    '''
+    __slots__ = ('change', 'patchset', 'last_updated', 'taken', 'approvals', 'jobs')
+
+    def __init__(self, change, patchset, last_updated, taken, approvals, jobs):
+        self.change = change
+        self.patchset = patchset
+        self.last_updated = last_updated
+        self.taken = taken
+        self.approvals = approvals
+        self.jobs = jobs
+
+    def __repr__(self):
+        return 'Snapshot({}, {}, {})'.format(self.change, self.patchset, self.last_updated)
+
+
+class SnapshotStore(object):
+    '''
+    A local SQLite (WAL) store of the change records: each new
+    version of a change is saved as a snapshot, so the state
+    survives a restart and two versions can be compared.
+    '''
+
+    def __init__(self, path, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 keep=KEEP, clock=time.time):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.keep = keep
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending = []
+        self._oldest = None
+        self._timer = None
+        # snapshots taken before are not used to warm start the cache
+        self._trusted = 0
+        # the last_updated of the latest snapshot of each change
+        self._known = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA foreign_keys=ON')
+        self._db.executescript(_SCHEMA)
+
+    def put(self, record):
+        '''
+        Queue a snapshot of the record, unless it's the version
+        already stored.
+        '''
+        change = str(record.number)
+        with self._lock:
+            if self._last_updated(change) == record.last_updated:
+                return
+            self._known[change] = record.last_updated
+            self._pending.append((self._clock(), record))
+            if self._oldest is None:
+                self._oldest = self._clock()
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            if len(self._pending) >= self.batch_size or \
+                    self._clock() - self._oldest >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def last_updated(self, change):
+        '''
+        The last_updated of the latest snapshot of the change, None
+        if it was never stored.
+        '''
+        with self._lock:
+            return self._last_updated(str(change))
+
+    def distrust(self, since=None):
+        '''
+        Don't rebuild the records stored before `since` (default:
+        now), e.g. their comments were filtered by another CI list;
+        they're still compared.
+        '''
+        with self._lock:
+            self._trusted = since if since is not None else self._clock()
+
+    def _last_updated(self, change):
+        if change not in self._known:
+            row = self._db.execute(
+                'SELECT last_updated FROM snapshots WHERE change = ? ORDER BY id DESC LIMIT 1',
+                (change,)).fetchone()
+            self._known[change] = row[0] if row is not None else None
+        return self._known[change]
+
+    def _flush(self):
+        pending, self._pending, self._oldest = self._pending, [], None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not pending:
+            return
+        parser = ci_parser.get_parser()
+        with self._db:
+            for taken, record in pending:
+                change = str(record.number)
+                ps = record.current_patch_set
+                # parsing is incremental: the comments are usually
+                # already known to the parser
+                parser.update(change, record.comments)
+                cur = self._db.execute(
+                    'INSERT INTO snapshots (change, patchset, last_updated, taken, project, '
+                    'branch, subject, url, status, kind, revision, ci_running) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (change, ps.number, record.last_updated, taken, record.project,
+                     record.branch, record.subject, record.url, record.status, ps.kind,
+                     ps.revision, ps.approvals is None))
+                sid = cur.lastrowid
+                self._db.executemany(
+                    'INSERT INTO approvals (snapshot, by, type, value) VALUES (?, ?, ?, ?)',
+                    [(sid, a.by, a.type, a.value) for a in ps.approvals or []])
+                self._db.executemany(
+                    'INSERT INTO jobs (snapshot, name, url, result, duration, voting) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [(sid, j.name, j.url, j.result, j.duration, j.voting)
+                     for j in parser.jobs(change, ps.number).values()])
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO comments (change, timestamp, reviewer, message) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(change, c.timestamp, c.reviewer, c.message) for c in record.comments])
+                self._prune(change)
+        log.debug("Stored %d snapshot(s)", len(pending))
+
+    def _prune(self, change):
+        self._db.execute(
+            'DELETE FROM snapshots WHERE change = ? AND id NOT IN '
+            '(SELECT id FROM snapshots WHERE change = ? ORDER BY id DESC LIMIT ?)',
+            (change, change, self.keep))
+        self._db.execute(
+            'DELETE FROM comments WHERE change = ? AND timestamp < '
+            '(SELECT COALESCE(MIN(timestamp), 0) FROM (SELECT timestamp FROM comments '
+            'WHERE change = ? ORDER BY timestamp DESC LIMIT ?))',
+            (change, change, self.keep))
+
+    def snapshots(self, change, limit=2):
+        '''
+        Return the latest snapshots of a change, newest first.
+        '''
+        change = str(change)
+        with self._lock:
+            self._flush()
+            rows = self._db.execute(
+                'SELECT id, patchset, last_updated, taken, ci_running FROM snapshots '
+                'WHERE change = ? ORDER BY id DESC LIMIT ?', (change, limit)).fetchall()
+            return [self._load_snapshot(change, *row) for row in rows]
+
+    def _approvals(self, sid, ci_running):
+        if ci_running:
+            return None
+        return [Approval(*a) for a in self._db.execute(
+            'SELECT by, type, value FROM approvals WHERE snapshot = ?', (sid,))]
+
+    def _load_snapshot(self, change, sid, patchset, last_updated, taken, ci_running):
+        approvals = self._approvals(sid, ci_running)
+        jobs = dict((j[0], ci_parser.JobResult(j[0], j[1], j[2], j[3], bool(j[4])))
+                    for j in self._db.execute(
+                        'SELECT name, url, result, duration, voting FROM jobs '
+                        'WHERE snapshot = ?', (sid,)))
+        return Snapshot(change, patchset, last_updated, taken, approvals, jobs)
+
+    def latest(self, change):
+        '''
+        Rebuild the last stored record of a change (comments
+        included), None if the change is unknown.
+        '''
+        change = str(change)
+        with self._lock:
+            self._flush()
+            row = self._db.execute(
+                'SELECT id, patchset, last_updated, project, branch, subject, url, status, '
+                'kind, revision, ci_running, taken FROM snapshots WHERE change = ? '
+                'ORDER BY id DESC LIMIT 1', (change,)).fetchone()
+            if row is None or row[-1] < self._trusted:
+                return None
+            sid, psnum, last_updated, project, branch, subject, url, status, \
+                kind, revision, ci_running, _ = row
+            approvals = self._approvals(sid, ci_running)
+            comments = [CIComment(*c) for c in self._db.execute(
+                'SELECT timestamp, reviewer, message FROM comments WHERE change = ? '
+                'ORDER BY timestamp', (change,))]
+        return ChangeRecord(int(change), project, branch, subject, url, status, last_updated,
+                            PatchSet(psnum, kind, revision, approvals), comments)
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._db.close()
+
+
+def diff(old, new):
+    '''
+    Describe what changed between two snapshots of a change: the
+    new patchset, the new (or changed) votes and job results.
+    '''
+    out = []
+    if new.patchset != old.patchset:
+        out.append('PS {} -> {}'.format(old.patchset, new.patchset))
+
+    old_votes = dict(((a.by, a.type), a.value) for a in old.approvals or [])
+    votes = []
+    for a in new.approvals or []:
+        prev = old_votes.get((a.by, a.type), None)
+        if prev != a.value:
+            votes.append('{} {} {:+d}{}'.format(
+                a.by, a.type, a.value, ' (was {:+d})'.format(prev) if prev is not None else ''))
+    if new.approvals is None and old.approvals is not None:
+        votes.append('CI running')
+    if votes:
+        out.append('votes: ' + ', '.join(votes))
+
+    # the job results of the same patchset are compared, all of
+    # them are new on a new patchset
+    old_jobs = old.jobs if new.patchset == old.patchset else {}
+    jobs = []
+    for name, job in sorted(new.jobs.items()):
+        prev = old_jobs.get(name, None)
+        if prev is None or prev.result != job.result:
+            jobs.append('{} {}{}'.format(
+                name, job.result, ' (was {})'.format(prev.result) if prev is not None else ''))
+    if jobs:
+        out.append('jobs: ' + ', '.join(jobs))
+    return out
+
+
+_store = None
+_store_lock = threading.Lock()
+# when the config last changed the way the records are filtered
+_distrusted = None
+
+
+def get_store(conf):
+    '''
+    Return the process wide store, built according to the 'store'
+    section of the gerrit config; None if it's not configured.
+    '''
+    global _store
+    opts = conf.get('store', {})
+    if not opts.get('path', None):
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = SnapshotStore(opts['path'],
+                                   batch_size=int(opts.get('batch_size', BATCH_SIZE)),
+                                   flush_interval=opts.get('flush_interval', FLUSH_INTERVAL),
+                                   keep=int(opts.get('keep', KEEP)))
+            # don't lose the pending snapshots
+            atexit.register(_store.close)
+            if _distrusted is not None:
+                _store.distrust(_distrusted)
+        return _store
+
+
+def reconfigure(old, new):
+    '''
+    Apply a reloaded gerrit config: the store is closed (the pending
+    snapshots are written) and opened again on the next use if its
+    settings changed. The records stored so far don't warm start the
+    cache anymore if they were built for another CI list or history
+    size, like the cache is cleared.
+    '''
+    global _store, _distrusted
+    refiltered = old.get('allowed_ci') != new.get('allowed_ci') or \
+        old.get('ci_history') != new.get('ci_history')
+    with _store_lock:
+        store = _store
+        if refiltered:
+            _distrusted = time.time()
+        if old.get('store', {}) != new.get('store', {}):
+            _store = None
+    if store is None:
+        return
+    if store is not _store:
+        store.close()
+        log.info("Snapshot store closed, the next one uses the new settings")
+    elif refiltered:
+        store.distrust(_distrusted)
+        log.info("Snapshot store not used to warm start the cache anymore")
@@ -0,0 +1,307 @@
+#!/usr/bin/python
+
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import logging
+import random
+import threading
+import time
+
+from lib import metrics
+from lib import patch_set as ps
+
+
+# Seconds between two checks of a change: MIN_INTERVAL while CI is
+# running (or something just happened), then multiplied by BACKOFF at
+# each idle check, up to MAX_INTERVAL
+MIN_INTERVAL = 60
+MAX_INTERVAL = 1800
+BACKOFF = 2
+
+# Each interval is randomly stretched or shrunk by up to this
+# fraction, so the checks don't hit gerrit all at the same time
+JITTER = 0.1
+
+# Max number of gerrit operations (queries, rebase, recheck) run at
+# the same time by the scheduler
+MAX_CONCURRENT = 2
+
+# How many times a failed patchset is rebased/rechecked before giving up
+MAX_RETRIES = 1
+
+# Change states
+RUNNING = 'running'
+FAILED = 'failed'
+PASSED = 'passed'
+CLOSED = 'closed'
+
+log = logging.getLogger(__name__)
+
+
+def classify(conf, record):
+    '''
+    Tell where the current patchset of a change is: CI still
+    running (no votes yet), failed (an allowed CI voted -1/-2),
+    passed, or the change is closed.
+    '''
+    if record.status in ('MERGED', 'ABANDONED'):
+        return CLOSED
+    approvals = record.current_patch_set.approvals
+    if approvals is None:
+        return RUNNING
+    allowed_ci = conf.get('allowed_ci', [])
+    for a in approvals:
+        if a.by in allowed_ci and a.type == 'Verified' and a.value < 0:
+            return FAILED
+    return PASSED
+
+
+def failed_at(conf, record):
+    '''
+    When the allowed CI(s) last reported on the change: the latest
+    of their comments and votes. Unlike lastUpdated, it doesn't move
+    when the bot itself rechecks or rebases.
+    '''
+    allowed_ci = conf.get('allowed_ci', [])
+    times = [a.granted for a in record.current_patch_set.approvals or [] if a.by in allowed_ci]
+    times += [c.timestamp for c in record.comments if c.reviewer in allowed_ci]
+    return max(times) if times else 0
+
+
+class _Watch(object):
+    __slots__ = ('change', 'actions', 'interval', 'last_updated', 'state',
+                 'patchset', 'retries', 'acted_at', 'busy')
+
+    def __init__(self, change, actions, interval):
+        self.change = change
+        self.actions = actions
+        self.interval = interval
+        self.last_updated = None
+        self.state = None
+        self.patchset = None
+        self.retries = 0
+        self.acted_at = None
+        self.busy = False
+
+
+class WatchScheduler(object):
+    '''
+    Periodically check the submissions with the 'watch' action and,
+    when CI fails, run the configured policy: rebase (if 'rebase' is
+    listed) or, when that's not possible, recheck (if 'recheck' is
+    listed).
+
+    Changes with CI running are checked every min_interval seconds,
+    the idle ones back off exponentially up to max_interval. The due
+    changes are checked with a single batch query and at most
+    max_concurrent gerrit operations run at the same time.
+    '''
+
+    def __init__(self, conf, announce, clock=time.monotonic, rand=random.random, query=None):
+        '''
+        :param announce is called with the message to post
+        :param query returns {change: record} for a list of changes
+            (default: a batch gerrit query)
+        '''
+        opts = conf.get('watch', {})
+        self.conf = conf
+        self.announce = announce
+        self.min_interval = opts.get('min_interval', MIN_INTERVAL)
+        self.max_interval = opts.get('max_interval', MAX_INTERVAL)
+        self.backoff = opts.get('backoff', BACKOFF)
+        self.jitter = opts.get('jitter', JITTER)
+        self.max_retries = opts.get('max_retries', MAX_RETRIES)
+
+        self._clock = clock
+        self._rand = rand
+        self._query = query if query is not None else \
+            (lambda changes: ps.query_changes(self.conf, changes))
+        self._ops = ThreadPoolExecutor(max_workers=opts.get('max_concurrent', MAX_CONCURRENT),
+                                       thread_name_prefix='cephbot-watch')
+        self._watches = {}
+        self._due = []
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+        self.update(conf)
+
+    def update(self, conf):
+        '''
+        Follow the submissions of a (new) config: the newly watched
+        ones are scheduled, the ones not watched anymore dropped.
+        '''
+        watched = {}
+        for change, sub in conf.get('submissions', {}).items():
+            actions = sub.get('actions', [])
+            if 'watch' in actions:
+                watched[str(change)] = frozenset(actions)
+
+        with self._cond:
+            self.conf = conf
+            for change in list(self._watches):
+                if change not in watched:
+                    log.info("Not watching %s anymore", change)
+                    del self._watches[change]
+            now = self._clock()
+            for change, actions in watched.items():
+                w = self._watches.get(change, None)
+                if w is not None:
+                    w.actions = actions
+                    continue
+                w = self._watches[change] = _Watch(change, actions, self.min_interval)
+                # spread the first checks over the first interval
+                heapq.heappush(self._due, (now + self._rand() * self.min_interval, w.change))
+            self._cond.notify()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='gerrit-watch', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._ops.shutdown(wait=False)
+
+    def poke(self, change):
+        '''
+        Check the change as soon as possible (e.g. something
+        happened according to the event stream).
+        '''
+        w = self._watches.get(str(change), None)
+        if w is None:
+            return
+        with self._cond:
+            w.interval = self.min_interval
+            heapq.heappush(self._due, (self._clock(), w.change))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'watched': len(self._watches),
+                'scheduled': len(set(c for _, c in self._due)),
+                'running': sum(1 for w in self._watches.values() if w.state == RUNNING),
+                'failed': sum(1 for w in self._watches.values() if w.state == FAILED),
+            }
+
+    def _next(self, interval):
+        return self._clock() + interval * (1 + self.jitter * (2 * self._rand() - 1))
+
+    def _pop_due(self):
+        '''
+        Wait for (and return) the changes due to be checked, an
+        empty list when stopped.
+        '''
+        with self._cond:
+            while not self._stop:
+                now = self._clock()
+                if self._due and self._due[0][0] <= now:
+                    due = set()
+                    while self._due and self._due[0][0] <= now:
+                        due.add(heapq.heappop(self._due)[1])
+                    # a poked change can be in the heap twice
+                    self._due = [x for x in self._due if x[1] not in due]
+                    heapq.heapify(self._due)
+                    return sorted(due)
+                self._cond.wait(self._due[0][0] - now if self._due else None)
+            return []
+
+    def _run(self):
+        while True:
+            due = self._pop_due()
+            if not due:
+                return
+            try:
+                self._ops.submit(self.check, due).result()
+            except Exception as e:
+                log.warning("Unable to check %s: %s", ', '.join(due), e)
+                for change in due:
+                    w = self._watches.get(change, None)
+                    if w is not None:
+                        self._schedule(w, False)
+
+    def _schedule(self, w, active):
+        '''
+        Schedule the next check of the change: soon if it's active
+        (CI running or failed, or just updated), backing off
+        otherwise.
+        '''
+        if active:
+            w.interval = self.min_interval
+        else:
+            w.interval = min(w.interval * self.backoff, self.max_interval)
+        with self._cond:
+            heapq.heappush(self._due, (self._next(w.interval), w.change))
+            self._cond.notify()
+
+    def check(self, changes):
+        '''
+        Check the given changes with a single query and act on the
+        failed ones.
+        '''
+        records = self._query(changes)
+        metrics.inc('cephbot_watch_checks_total', len(changes))
+        for change in changes:
+            w = self._watches.get(change, None)
+            if w is None:
+                continue
+            record = records.get(change, None)
+            if record is None:
+                log.warning("Watched change %s not found", change)
+                self._schedule(w, False)
+                continue
+
+            state = classify(self.conf, record)
+            updated = w.last_updated is not None and record.last_updated != w.last_updated
+            psnum = record.current_patch_set.number
+            if psnum != w.patchset:
+                w.patchset = psnum
+                w.retries = 0
+            w.last_updated = record.last_updated
+            w.state = state
+
+            if state == CLOSED:
+                log.info("Change %s is %s, not watching it anymore", change, record.status)
+                with self._cond:
+                    del self._watches[change]
+                continue
+            if state == FAILED and self._should_act(w, record):
+                w.busy = True
+                w.retries += 1
+                w.acted_at = failed_at(self.conf, record)
+                self._ops.submit(self._act, w, psnum)
+            self._schedule(w, updated or state in (RUNNING, FAILED))
+
+    def _should_act(self, w, record):
+        if w.busy or not (w.actions & {'rebase', 'recheck'}):
+            return False
+        if w.retries >= self.max_retries:
+            return False
+        # don't act twice on the same failure: our own recheck or
+        # rebase updates the change, only a new CI report counts
+        return w.acted_at is None or failed_at(self.conf, record) > w.acted_at
+
+    def _act(self, w, psnum):
+        '''
+        Run the rebase-else-recheck policy on the failed patchset.
+        '''
+        try:
+            if 'rebase' in w.actions and ps._rebase(self.conf, w.change, psnum, ['rebase']):
+                action = 'rebased'
+            elif 'recheck' in w.actions:
+                ps._recheck(self.conf, w.change, psnum,
+                            **{'message': 'recheck', 'code-review': 0})
+                action = 'rechecked'
+            else:
+                return
+            metrics.inc('cephbot_watch_actions_total', action=action)
+            self.announce('Review {} PS {} failed CI: {}'.format(w.change, psnum, action))
+        except Exception as e:
+            log.warning("Unable to rebase/recheck %s: %s", w.change, e)
+        finally:
+            w.busy = False
+            self.poke(w.change)